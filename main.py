@@ -7,7 +7,14 @@ from fastapi import FastAPI
 from src.utils.config import settings
 from src.utils.logger import logger
 from src.utils.database import db
+from src.services.conversation_service import conversation_service
+from src.services.feishu_doc_service import feishu_doc_service
+from src.services.llm_service import llm_service
+from src.services.media_process_service import media_process_service
+from src.services.message_service import message_service
 from src.api.webhook import router as webhook_router
+from src.api.webhook import start_message_workers, stop_message_workers
+from src.api.webhook import init_redis, close_redis
 
 # 创建FastAPI应用
 app = FastAPI(
@@ -25,11 +32,21 @@ async def startup_event():
     """应用启动时执行"""
     logger.info(f"{settings.app_name} v{settings.app_version} 启动成功")
     logger.info(f"数据库路径: {db.db_path}")
+    await init_redis()
+    start_message_workers()
 
 
 @app.on_event("shutdown")
 async def shutdown_event():
     """应用关闭时执行"""
+    await stop_message_workers()
+    await close_redis()
+    await feishu_doc_service.aclose()
+    await llm_service.aclose()
+    await media_process_service.aclose()
+    await message_service.aclose()
+    conversation_service.close()
+    db.close()
     logger.info(f"{settings.app_name} 已关闭")
 
 
@@ -57,5 +74,7 @@ if __name__ == "__main__":
         "main:app",
         host=settings.host,
         port=settings.port,
-        reload=settings.debug
+        reload=settings.debug,
+        loop="uvloop",
+        http="httptools"
     )
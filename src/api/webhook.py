@@ -3,13 +3,18 @@
 接收和处理飞书机器人发送的事件回调
 """
 
-from fastapi import APIRouter, Request, HTTPException, BackgroundTasks
-from typing import Dict, Any
-import json
+from fastapi import APIRouter, Request, HTTPException
+from fastapi.responses import ORJSONResponse
+from typing import Dict, Any, List, Optional
+from collections import OrderedDict
+import orjson
+import asyncio
 import base64
 import hashlib
 import time
-from Crypto.Cipher import AES
+from functools import lru_cache
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 
 from src.utils.config import settings
 from src.utils.logger import logger
@@ -25,8 +30,37 @@ text_handler = TextHandler()
 voice_handler = VoiceHandler()
 media_handler = MediaHandler()
 
-# 消息去重缓存（简单实现，生产环境建议使用Redis）
-processed_messages = {}
+# 消息类型 -> 处理器
+MESSAGE_HANDLERS = {
+    "text": text_handler,
+    "audio": voice_handler,
+    "image": media_handler,
+    "media": media_handler,
+}
+
+# 消息去重缓存（单进程内有效，多进程部署请配置 REDIS_URL）
+# 按插入时间有序，便于从最旧的一端淘汰
+processed_messages: "OrderedDict[str, float]" = OrderedDict()
+
+# 去重记录有效期（秒）和最大条数
+DEDUP_TTL = 300
+MAX_DEDUP = 10000
+
+# 配置 REDIS_URL 时使用Redis做跨进程去重（应用启动时连接），本地缓存作为一级缓存
+REDIS_DEDUP_PREFIX = "fs:msg:"
+redis_client = None
+
+# 加密请求体重放缓存（飞书超时重试会发送相同的密文），命中时无需再解密
+replayed_bodies: "OrderedDict[bytes, float]" = OrderedDict()
+REPLAY_TTL = 30
+
+# 消息处理队列（应用启动时创建），由固定数量的worker消费
+MESSAGE_QUEUE_SIZE = 1000
+MESSAGE_WORKER_COUNT = 4
+# 应用关闭时等待队列中剩余消息处理完成的最长时间（秒）
+MESSAGE_DRAIN_TIMEOUT = 10.0
+message_queue: Optional[asyncio.Queue] = None
+_workers: List[asyncio.Task] = []
 
 
 class AESCipher:
@@ -41,7 +75,11 @@ class AESCipher:
         """
         # 使用SHA256生成32字节密钥
         self.key = hashlib.sha256(key.encode('utf-8')).digest()
-        self.block_size = AES.block_size
+        self.block_size = algorithms.AES.block_size // 8
+        
+        # 与IV无关的对象只创建一次，每次解密只需构建CBC解密上下文
+        self._algorithm = algorithms.AES(self.key)
+        self._backend = default_backend()
     
     def decrypt(self, encrypted_data: str) -> str:
         """
@@ -55,28 +93,46 @@ class AESCipher:
         """
         try:
             # Base64解码
-            encrypted_bytes = base64.b64decode(encrypted_data)
+            encrypted_bytes = memoryview(base64.b64decode(encrypted_data))
             
-            # 提取IV（前16字节）和密文
-            iv = encrypted_bytes[:self.block_size]
+            # 提取IV（前16字节）和密文，使用memoryview避免复制
+            iv = bytes(encrypted_bytes[:self.block_size])
             ciphertext = encrypted_bytes[self.block_size:]
             
-            # 创建AES解密器
-            cipher = AES.new(self.key, AES.MODE_CBC, iv)
+            # 创建AES解密器（OpenSSL后端，支持AES-NI硬件加速），复用已展开的密钥对象
+            decryptor = Cipher(self._algorithm, modes.CBC(iv), backend=self._backend).decryptor()
             
-            # 解密
-            decrypted = cipher.decrypt(ciphertext)
+            # 解密（密文为整块，update即返回全部明文）
+            decrypted = decryptor.update(ciphertext) + decryptor.finalize()
             
-            # 去除PKCS7填充
-            pad_length = decrypted[-1]
-            decrypted = decrypted[:-pad_length]
+            # 校验并去除PKCS7填充：填充长度需在1~block_size之间，且填充字节全部等于该长度
+            pad_length = decrypted[-1] if decrypted else 0
+            if not 0 < pad_length <= self.block_size or \
+                    decrypted[-pad_length:] != bytes((pad_length,)) * pad_length:
+                raise ValueError("PKCS7填充无效")
             
-            return decrypted.decode('utf-8')
+            # 通过memoryview截掉填充后直接解码，避免复制明文
+            return str(memoryview(decrypted)[:-pad_length], 'utf-8')
         except Exception as e:
-            logger.error(f"解密失败: {e}")
+            logger.error("解密失败: %s", e)
             raise
 
 
+@lru_cache()
+def get_cipher(encrypt_key: str) -> AESCipher:
+    """
+    获取AES解密器（按密钥缓存）
+    使用lru_cache避免每次请求重复派生SHA256密钥
+    
+    Args:
+        encrypt_key: 飞书加密密钥
+        
+    Returns:
+        AES解密器实例
+    """
+    return AESCipher(encrypt_key)
+
+
 def decrypt_message(encrypt_data: str) -> Dict[str, Any]:
     """
     解密飞书消息
@@ -90,14 +146,58 @@ def decrypt_message(encrypt_data: str) -> Dict[str, Any]:
     if not settings.feishu_encrypt_key:
         raise ValueError("FEISHU_ENCRYPT_KEY 未配置")
     
-    cipher = AESCipher(settings.feishu_encrypt_key)
+    cipher = get_cipher(settings.feishu_encrypt_key)
     decrypted_str = cipher.decrypt(encrypt_data)
-    return json.loads(decrypted_str)
+    return orjson.loads(decrypted_str)
+
+
+def _evict_expired(cache: OrderedDict, ttl: float, current_time: float):
+    """
+    从最旧的一端清理过期记录
+    记录按时间有序，遇到未过期的即可停止
+    
+    Args:
+        cache: 记录缓存（值为记录时间）
+        ttl: 有效期（秒）
+        current_time: 当前时间
+    """
+    while cache:
+        oldest_time = next(iter(cache.values()))
+        if current_time - oldest_time <= ttl:
+            break
+        cache.popitem(last=False)
 
 
-def is_duplicate_message(message_id: str) -> bool:
+def is_replayed_body(body_hash: bytes) -> bool:
+    """
+    检查加密请求体是否为近期重放
+    
+    Args:
+        body_hash: 请求体摘要
+        
+    Returns:
+        是否重放
+    """
+    _evict_expired(replayed_bodies, REPLAY_TTL, time.time())
+    return body_hash in replayed_bodies
+
+
+def remember_body(body_hash: bytes):
+    """
+    记录已处理的加密请求体
+    
+    Args:
+        body_hash: 请求体摘要
+    """
+    replayed_bodies[body_hash] = time.time()
+    while len(replayed_bodies) > MAX_DEDUP:
+        replayed_bodies.popitem(last=False)
+
+
+async def is_duplicate_message(message_id: str) -> bool:
     """
     检查消息是否已处理（防重）
+    先查本地缓存，未命中且配置了Redis时再用 SET NX EX 做跨进程去重
     
     Args:
         message_id: 消息ID
@@ -108,19 +208,72 @@ def is_duplicate_message(message_id: str) -> bool:
     current_time = time.time()
     
     # 清理过期记录（5分钟前的）
-    expired_keys = [k for k, v in processed_messages.items() if current_time - v > 300]
-    for k in expired_keys:
-        del processed_messages[k]
+    _evict_expired(processed_messages, DEDUP_TTL, current_time)
     
     # 检查是否已处理
     if message_id in processed_messages:
         return True
     
-    # 记录消息
+    # 记录消息，超出上限时淘汰最旧的记录
     processed_messages[message_id] = current_time
+    while len(processed_messages) > MAX_DEDUP:
+        processed_messages.popitem(last=False)
+    
+    # 其他进程可能已处理过该消息
+    if redis_client is not None:
+        try:
+            is_new = await redis_client.set(
+                REDIS_DEDUP_PREFIX + message_id, "1", nx=True, ex=DEDUP_TTL
+            )
+            return not is_new
+        except Exception as e:
+            logger.error("Redis去重失败，仅使用本地缓存: %s", e)
     return False
 
 
+async def forget_message(message_id: str):
+    """
+    撤销消息的去重记录（消息未能处理时调用，让飞书重试能被接受）
+    
+    Args:
+        message_id: 消息ID
+    """
+    processed_messages.pop(message_id, None)
+    if redis_client is not None:
+        try:
+            await redis_client.delete(REDIS_DEDUP_PREFIX + message_id)
+        except Exception as e:
+            logger.error("撤销Redis去重记录失败: %s", e)
+
+
+async def init_redis():
+    """连接Redis去重存储（应用启动时调用，未配置 REDIS_URL 时跳过）"""
+    global redis_client
+    if not settings.redis_url:
+        return
+    try:
+        # redis 为可选依赖，只在配置了 REDIS_URL 时导入
+        from redis import asyncio as aioredis
+    except ImportError:
+        logger.error("已配置 REDIS_URL 但未安装 redis 包（pip install redis==5.0.0），使用本地去重")
+        return
+    try:
+        redis_client = aioredis.from_url(settings.redis_url)
+        await redis_client.ping()
+        logger.info("Redis去重已启用")
+    except Exception as e:
+        redis_client = None
+        logger.error("连接Redis失败，使用本地去重: %s", e)
+
+
+async def close_redis():
+    """关闭Redis连接（应用关闭时调用）"""
+    global redis_client
+    if redis_client is not None:
+        await redis_client.close()
+        redis_client = None
+
+
 async def process_message_async(message: Dict[str, Any], sender: Dict[str, Any], message_type: str):
     """
     异步处理消息（后台任务）
@@ -131,54 +284,202 @@ async def process_message_async(message: Dict[str, Any], sender: Dict[str, Any],
         message_type: 消息类型
     """
     try:
-        # 合并消息和发送者信息
-        full_message = {**message, "sender": sender}
+        # 解析一次消息内容，供各处理器直接使用
+        # message 是本次请求独占的字典，直接写入即可，无需复制
+        content_str = message.get("content")
+        message["_content"] = orjson.loads(content_str) if content_str else {}
         
         # 根据消息类型分发到不同的处理器
-        if message_type == "text":
-            await text_handler.handle(full_message)
-        elif message_type == "audio":
-            await voice_handler.handle(full_message)
-        elif message_type in ["image", "media"]:
-            await media_handler.handle(full_message)
+        handler = MESSAGE_HANDLERS.get(message_type)
+        if handler:
+            await handler.handle(message, sender)
         else:
-            logger.warning(f"不支持的消息类型: {message_type}")
+            logger.warning("不支持的消息类型: %s", message_type)
             
     except Exception as e:
-        logger.error(f"异步处理消息失败: {e}")
+        logger.error("异步处理消息失败: %s", e)
+
+
+async def _message_worker(queue: asyncio.Queue):
+    """
+    消息处理worker，持续从队列中取出消息并处理
+    
+    Args:
+        queue: 消息队列（关闭时全局 message_queue 会先置空，worker 继续处理这个队列）
+    """
+    while True:
+        message, sender, message_type = await queue.get()
+        try:
+            await process_message_async(message, sender, message_type)
+        except asyncio.CancelledError:
+            # 关闭时处理到一半被取消，撤销去重记录让飞书重试能被接受
+            await forget_message(message.get("message_id", ""))
+            raise
+        finally:
+            queue.task_done()
+
+
+def start_message_workers():
+    """创建消息队列并启动worker（应用启动时调用）"""
+    global message_queue
+    message_queue = asyncio.Queue(maxsize=MESSAGE_QUEUE_SIZE)
+    for _ in range(MESSAGE_WORKER_COUNT):
+        _workers.append(asyncio.create_task(_message_worker(message_queue)))
+    logger.info("消息处理worker已启动: %s 个", MESSAGE_WORKER_COUNT)
+
+
+async def stop_message_workers():
+    """
+    停止所有worker（应用关闭时调用）
+    队列中的消息已向飞书返回成功、不会被重新推送，先等待处理完成；
+    超时后仍未处理完的消息（含处理中被取消的）撤销去重记录，让飞书的后续重试能被其他进程接受
+    """
+    global message_queue
+    queue, message_queue = message_queue, None
+    if queue is not None and _workers:
+        try:
+            await asyncio.wait_for(queue.join(), MESSAGE_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning("等待消息处理超时，剩余 %s 条未处理", queue.qsize())
+    
+    for worker in _workers:
+        worker.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
+    
+    if queue is not None:
+        while not queue.empty():
+            message, _, _ = queue.get_nowait()
+            await forget_message(message.get("message_id", ""))
 
 
-@router.post("/event")
-async def handle_event(request: Request, background_tasks: BackgroundTasks) -> Dict[str, Any]:
+async def handle_message_received(event_data: Dict[str, Any]) -> Optional[ORJSONResponse]:
+    """
+    处理消息接收事件
+    
+    Args:
+        event_data: 事件数据
+        
+    Returns:
+        需要直接返回给飞书的响应，正常情况返回None
+    """
+    message = event_data.get("message", {})
+    sender = event_data.get("sender", {})
+    message_type = message.get("message_type", "")
+    message_id = message.get("message_id", "")
+
+    # 不支持的消息类型直接跳过，不占用去重缓存和消息队列
+    if message_type not in MESSAGE_HANDLERS:
+        logger.warning("不支持的消息类型: %s", message_type)
+        return None
+
+    # 检查消息是否已处理（防重）
+    if await is_duplicate_message(message_id):
+        logger.info("消息已处理，跳过: %s", message_id)
+        return None
+
+    logger.info("收到消息，类型: %s, id: %s", message_type, message_id)
+
+    # worker未启动或正在关闭时返回503，让飞书稍后重试
+    if message_queue is None:
+        await forget_message(message_id)
+        logger.warning("消息处理worker未运行，拒绝消息: %s", message_id)
+        return ORJSONResponse(
+            status_code=503,
+            content={"code": 1, "msg": "unavailable"}
+        )
+
+    # 放入消息队列由worker处理，立即返回响应
+    try:
+        message_queue.put_nowait((message, sender, message_type))
+    except asyncio.QueueFull:
+        # 队列已满，撤销去重记录并返回429，让飞书稍后重试
+        await forget_message(message_id)
+        logger.warning("消息队列已满，拒绝消息: %s", message_id)
+        return ORJSONResponse(
+            status_code=429,
+            content={"code": 1, "msg": "busy"}
+        )
+    return None
+
+
+async def handle_file_deleted(event_data: Dict[str, Any]) -> Optional[ORJSONResponse]:
+    """
+    处理文档彻底删除事件
+    
+    Args:
+        event_data: 事件数据
+        
+    Returns:
+        需要直接返回给飞书的响应，正常情况返回None
+    """
+    file_token = event_data.get("file_token", "")
+    file_type = event_data.get("file_type", "")
+
+    logger.info("收到文档彻底删除事件: %s, 类型: %s", file_token, file_type)
+
+    # 从数据库中删除对应的日记记录
+    if file_token:
+        # 查找并删除包含该文档ID的日记记录（数据库操作放到线程池中并行执行）
+        diaries = await asyncio.to_thread(diary_service.get_diaries_by_document_id, file_token)
+        if diaries:
+            diary_ids = [diary['id'] for diary in diaries if diary.get('id')]
+            results = await asyncio.gather(
+                *[asyncio.to_thread(diary_service.delete_diary, diary_id) for diary_id in diary_ids],
+                return_exceptions=True
+            )
+            for diary_id, success in zip(diary_ids, results):
+                if success is True:
+                    logger.info("日记记录已同步删除: %s, 文档: %s", diary_id, file_token)
+                else:
+                    logger.error("日记记录删除失败: %s", diary_id)
+        else:
+            logger.info("未找到关联的日记记录: %s", file_token)
+    return None
+
+
+# 事件类型 -> 处理函数
+EVENT_HANDLERS = {
+    "im.message.receive_v1": handle_message_received,
+    "drive.file.deleted_completely_v1": handle_file_deleted,
+}
+
+
+@router.post("/event", response_class=ORJSONResponse)
+async def handle_event(request: Request) -> Dict[str, Any]:
     """
     处理飞书事件回调
     
     Args:
         request: FastAPI请求对象
-        background_tasks: 后台任务
         
     Returns:
         响应数据
     """
     try:
-        # 获取请求体
+        # 获取请求体（orjson直接解析bytes，无需先decode）
         body = await request.body()
-        body_str = body.decode('utf-8')
-        
-        data = json.loads(body_str)
+        data = orjson.loads(body)
         
         # 处理加密消息
+        body_hash = None
         if "encrypt" in data:
+            # 飞书重试的密文与首次相同，命中重放缓存时直接返回，省去解密
+            body_hash = hashlib.blake2b(body, digest_size=16).digest()
+            if is_replayed_body(body_hash):
+                logger.info("重复的加密请求，跳过解密")
+                return {"code": 0, "msg": "success"}
             try:
-                decrypted_data = decrypt_message(data["encrypt"])
+                # 在线程池中解密，避免阻塞事件循环
+                decrypted_data = await asyncio.to_thread(decrypt_message, data["encrypt"])
                 data = decrypted_data
             except Exception as e:
-                logger.error(f"解密消息失败: {e}")
+                logger.error("解密消息失败: %s", e)
         
         # 处理URL验证（飞书首次配置回调时需要）
         if "challenge" in data:
             challenge = data["challenge"]
-            logger.info(f"收到challenge验证: {challenge}")
+            logger.info("收到challenge验证: %s", challenge)
             return {"challenge": challenge}
         
         # 解析事件数据
@@ -186,53 +487,27 @@ async def handle_event(request: Request, background_tasks: BackgroundTasks) -> D
         header = data.get("header", {})
         event_type = header.get("event_type", "")
         
-        # 处理消息接收事件
-        if event_type == "im.message.receive_v1":
-            message = event_data.get("message", {})
-            sender = event_data.get("sender", {})
-            message_type = message.get("message_type", "")
-            message_id = message.get("message_id", "")
+        # 根据事件类型分发到对应的处理函数，未处理的事件类型直接返回
+        event_handler = EVENT_HANDLERS.get(event_type)
+        if event_handler is None:
+            logger.info("忽略未处理的事件类型: %s", event_type)
+            return {"code": 0, "msg": "success"}
 
-            # 检查消息是否已处理（防重）
-            if is_duplicate_message(message_id):
-                logger.info(f"消息已处理，跳过: {message_id}")
-                return {"code": 0, "msg": "success"}
+        response = await event_handler(event_data)
+        if response is not None:
+            return response
 
-            logger.info(f"收到消息，类型: {message_type}, id: {message_id}")
-
-            # 使用后台任务处理消息，立即返回响应
-            background_tasks.add_task(process_message_async, message, sender, message_type)
-
-        # 处理文档彻底删除事件
-        elif event_type == "drive.file.deleted_completely_v1":
-            file_token = event_data.get("file_token", "")
-            file_type = event_data.get("file_type", "")
-
-            logger.info(f"收到文档彻底删除事件: {file_token}, 类型: {file_type}")
-
-            # 从数据库中删除对应的日记记录
-            if file_token:
-                # 查找并删除包含该文档ID的日记记录
-                diaries = diary_service.get_diaries_by_document_id(file_token)
-                if diaries:
-                    for diary in diaries:
-                        diary_id = diary.get('id')
-                        if diary_id:
-                            success = diary_service.delete_diary(diary_id)
-                            if success:
-                                logger.info(f"日记记录已同步删除: {diary_id}, 文档: {file_token}")
-                            else:
-                                logger.error(f"日记记录删除失败: {diary_id}")
-                else:
-                    logger.info(f"未找到关联的日记记录: {file_token}")
+        # 只记录已处理的事件（不含challenge验证，拒绝的请求也不记录），以便重试能被接受
+        if body_hash is not None:
+            remember_body(body_hash)
 
         # 立即返回成功响应（避免飞书超时重试）
         return {"code": 0, "msg": "success"}
         
-    except json.JSONDecodeError as e:
-        logger.error(f"JSON解析错误: {e}")
+    except orjson.JSONDecodeError as e:
+        logger.error("JSON解析错误: %s", e)
         raise HTTPException(status_code=400, detail="Invalid JSON")
     except Exception as e:
-        logger.error(f"处理事件时出错: {e}")
+        logger.error("处理事件时出错: %s", e)
         # 即使出错也返回成功，避免飞书重试
         return {"code": 0, "msg": "success"}
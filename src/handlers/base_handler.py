@@ -4,10 +4,24 @@
 """
 
 from abc import ABC, abstractmethod
-from typing import Dict, Any
+from typing import Dict, Any, NamedTuple
 from src.utils.logger import logger
 
 
+class UserInfo(NamedTuple):
+    """用户信息"""
+    open_id: str
+    user_id: str
+    union_id: str
+
+
+class ChatInfo(NamedTuple):
+    """聊天信息"""
+    chat_id: str
+    chat_type: str
+    message_id: str
+
+
 class BaseHandler(ABC):
     """消息处理器基类"""
     
@@ -16,38 +30,38 @@ class BaseHandler(ABC):
         self.logger = logger
     
     @abstractmethod
-    async def handle(self, message: Dict[str, Any]) -> Dict[str, Any]:
+    async def handle(self, message: Dict[str, Any], sender: Dict[str, Any]) -> Dict[str, Any]:
         """
         处理消息的抽象方法
         
         Args:
             message: 飞书消息数据
+            sender: 发送者信息
             
         Returns:
             处理结果
         """
         pass
     
-    def extract_user_info(self, message: Dict[str, Any]) -> Dict[str, str]:
+    def extract_user_info(self, sender: Dict[str, Any]) -> UserInfo:
         """
         提取用户信息
         
         Args:
-            message: 飞书消息数据
+            sender: 发送者信息
             
         Returns:
-            用户信息字典
+            用户信息
         """
-        sender = message.get("sender", {})
         sender_id = sender.get("sender_id", {})
         
-        return {
-            "open_id": sender_id.get("open_id", ""),
-            "user_id": sender_id.get("user_id", ""),
-            "union_id": sender_id.get("union_id", "")
-        }
+        return UserInfo(
+            open_id=sender_id.get("open_id", ""),
+            user_id=sender_id.get("user_id", ""),
+            union_id=sender_id.get("union_id", "")
+        )
     
-    def extract_chat_info(self, message: Dict[str, Any]) -> Dict[str, str]:
+    def extract_chat_info(self, message: Dict[str, Any]) -> ChatInfo:
         """
         提取聊天信息
         
@@ -55,10 +69,10 @@ class BaseHandler(ABC):
             message: 飞书消息数据
             
         Returns:
-            聊天信息字典
+            聊天信息
         """
-        return {
-            "chat_id": message.get("chat_id", ""),
-            "chat_type": message.get("chat_type", ""),
-            "message_id": message.get("message_id", "")
-        }
+        return ChatInfo(
+            chat_id=message.get("chat_id", ""),
+            chat_type=message.get("chat_type", ""),
+            message_id=message.get("message_id", "")
+        )
@@ -4,50 +4,60 @@
 保存媒体信息到上下文，在生成日记时再下载上传
 """
 
-import json
 from typing import Dict, Any
-from .base_handler import BaseHandler
+from .base_handler import BaseHandler, UserInfo, ChatInfo
 from src.services.conversation_service import conversation_service
 from src.services.message_service import message_service
 
+# 超过该大小的视频会额外提示可能无法预览（20MB）
+LARGE_VIDEO_BYTES = 20 * 1024 * 1024
+
 
 class MediaHandler(BaseHandler):
     """媒体文件处理器"""
     
-    async def handle(self, message: Dict[str, Any]) -> Dict[str, Any]:
+    def __init__(self):
+        """初始化处理器"""
+        super().__init__()
+        # 消息类型 -> 处理方法
+        self._subhandlers = {
+            "image": self.handle_image,
+            "media": self.handle_video,
+        }
+    
+    async def handle(self, message: Dict[str, Any], sender: Dict[str, Any]) -> Dict[str, Any]:
         """
         处理媒体文件消息
         
         Args:
             message: 飞书媒体消息数据
+            sender: 发送者信息
             
         Returns:
             处理结果
         """
         try:
             # 提取用户信息
-            user_info = self.extract_user_info(message)
+            user_info = self.extract_user_info(sender)
             chat_info = self.extract_chat_info(message)
-            user_id = user_info['open_id']
+            user_id = user_info.open_id
             
             # 获取消息类型
             message_type = message.get("message_type", "")
             
-            self.logger.info(f"收到媒体消息，类型: {message_type}, 用户: {user_id}")
+            self.logger.info("收到媒体消息，类型: %s, 用户: %s", message_type, user_id)
             
             # 根据类型处理
-            if message_type == "image":
-                return await self.handle_image(message, user_info, chat_info)
-            elif message_type == "media":
-                return await self.handle_video(message, user_info, chat_info)
-            else:
+            subhandler = self._subhandlers.get(message_type)
+            if subhandler is None:
                 return {"code": 1, "msg": f"不支持的媒体类型: {message_type}"}
+            return await subhandler(message, user_info, chat_info)
                 
         except Exception as e:
-            self.logger.error(f"处理媒体消息时出错: {e}")
+            self.logger.error("处理媒体消息时出错: %s", e)
             return {"code": 1, "msg": f"媒体处理失败: {str(e)}"}
     
-    async def handle_image(self, message: Dict[str, Any], user_info: Dict[str, str], chat_info: Dict[str, str]) -> Dict[str, Any]:
+    async def handle_image(self, message: Dict[str, Any], user_info: UserInfo, chat_info: ChatInfo) -> Dict[str, Any]:
         """
         处理图片消息
         保存图片信息到上下文，在生成日记时再下载上传
@@ -61,17 +71,17 @@ class MediaHandler(BaseHandler):
             处理结果
         """
         try:
-            user_id = user_info['open_id']
+            user_id = user_info.open_id
             
-            # 解析消息内容获取图片信息
-            content = json.loads(message.get("content", "{}"))
+            # 使用webhook已解析的消息内容获取图片信息
+            content = message.get("_content", {})
             
             # 获取图片信息
             image_key = content.get("image_key", "")
             file_name = content.get("file_name", "image.jpg")
             message_id = message.get("message_id", "")
             
-            self.logger.info(f"处理图片: {file_name}, key: {image_key}, message_id: {message_id}")
+            self.logger.info("处理图片: %s, key: %s, message_id: %s", file_name, image_key, message_id)
             
             # 保存媒体信息到上下文（用于后续生成日记时下载上传）
             # 使用 message_id 和 image_key 作为 file_key 来下载资源
@@ -83,22 +93,17 @@ class MediaHandler(BaseHandler):
                 "status": "pending"  # 待处理状态
             }
             
-            # 添加媒体信息到上下文
-            conversation_service.add_media_to_context(user_id, media_info)
-            
-            # 添加文本描述到上下文
-            conversation_service.add_message(
-                user_id, 
-                "user", 
-                f"[图片: {file_name}]"
-            )
-            
             # 回复用户
             reply = "图片已收到，我会在整理日记时保存它。还有其他内容吗？"
             await message_service.send_text_message(user_id, reply)
             
-            # 保存助手回复
-            conversation_service.add_message(user_id, "assistant", reply)
+            # 一次性保存媒体信息、文本描述和助手回复到上下文
+            conversation_service.add_turn(
+                user_id,
+                media_info=media_info,
+                user_message=f"[图片: {file_name}]",
+                assistant_message=reply
+            )
             
             return {
                 "code": 0,
@@ -113,10 +118,10 @@ class MediaHandler(BaseHandler):
             }
             
         except Exception as e:
-            self.logger.error(f"处理图片失败: {e}")
+            self.logger.error("处理图片失败: %s", e)
             return {"code": 1, "msg": f"图片处理失败: {str(e)}"}
     
-    async def handle_video(self, message: Dict[str, Any], user_info: Dict[str, str], chat_info: Dict[str, str]) -> Dict[str, Any]:
+    async def handle_video(self, message: Dict[str, Any], user_info: UserInfo, chat_info: ChatInfo) -> Dict[str, Any]:
         """
         处理视频消息
         保存视频信息到上下文
@@ -130,20 +135,21 @@ class MediaHandler(BaseHandler):
             处理结果
         """
         try:
-            user_id = user_info['open_id']
+            user_id = user_info.open_id
             
-            # 解析消息内容获取视频信息
-            content = json.loads(message.get("content", "{}"))
+            # 使用webhook已解析的消息内容获取视频信息
+            content = message.get("_content", {})
             
             # 获取视频信息
             file_key = content.get("file_key", "")
             file_name = content.get("file_name", "video.mp4")
             file_size = content.get("file_size", 0)
-            size_mb = file_size / (1024 * 1024)
+            # 大小文本只格式化一次，日志、回复和上下文共用
+            size_text = f"{file_size / (1024 * 1024):.1f}MB"
             
-            self.logger.info(f"处理视频: {file_name}, key: {file_key}, size: {size_mb:.1f}MB")
+            self.logger.info("处理视频: %s, key: %s, size: %s", file_name, file_key, size_text)
             
-            # 保存媒体信息到上下文
+            # 媒体信息（随本轮对话一起写入上下文）
             media_info = {
                 "type": "video",
                 "file_name": file_name,
@@ -152,25 +158,21 @@ class MediaHandler(BaseHandler):
                 "status": "pending"
             }
             
-            conversation_service.add_media_to_context(user_id, media_info)
-            
-            # 添加文本描述到上下文
-            conversation_service.add_message(
-                user_id, 
-                "user", 
-                f"[视频: {file_name} ({size_mb:.1f}MB)]"
-            )
-            
             # 回复用户
-            if size_mb > 20:
-                reply = f"🎬 视频已收到（{size_mb:.1f}MB）。\n⚠️ 注意：视频较大，我会在整理日记时尝试保存，但可能无法在文档中直接预览。"
+            if file_size > LARGE_VIDEO_BYTES:
+                reply = f"🎬 视频已收到（{size_text}）。\n⚠️ 注意：视频较大，我会在整理日记时尝试保存，但可能无法在文档中直接预览。"
             else:
                 reply = "🎬 视频已收到，我会在整理日记时保存它。还有其他内容吗？"
             
             await message_service.send_text_message(user_id, reply)
             
-            # 保存助手回复
-            conversation_service.add_message(user_id, "assistant", reply)
+            # 一次性保存媒体信息、文本描述和助手回复到上下文
+            conversation_service.add_turn(
+                user_id,
+                media_info=media_info,
+                user_message=f"[视频: {file_name} ({size_text})]",
+                assistant_message=reply
+            )
             
             return {
                 "code": 0,
@@ -185,5 +187,5 @@ class MediaHandler(BaseHandler):
             }
             
         except Exception as e:
-            self.logger.error(f"处理视频失败: {e}")
+            self.logger.error("处理视频失败: %s", e)
             return {"code": 1, "msg": f"视频处理失败: {str(e)}"}
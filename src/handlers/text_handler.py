@@ -3,28 +3,119 @@
 处理用户发送的文字消息，集成LLM智能对话功能
 """
 
-import json
+import asyncio
 from typing import Dict, Any
-from datetime import datetime
-from .base_handler import BaseHandler
+from .base_handler import BaseHandler, ChatInfo, UserInfo
 from src.services.llm_service import llm_service
 from src.services.conversation_service import conversation_service
 from src.services.message_service import message_service
 from src.services.diary_service import diary_service
 from src.services.media_process_service import media_process_service
-from src.services.feishu_doc_service import feishu_doc_service
+from src.services.feishu_doc_service import feishu_doc_service, DOC_URL_PREFIX
+from src.utils.timeutil import today_str
 from uuid import uuid4
 
+# 批量删除飞书文档时的最大并发数（控制飞书API的QPS）
+DOC_DELETE_CONCURRENCY = 10
+_doc_delete_semaphore = asyncio.Semaphore(DOC_DELETE_CONCURRENCY)
+
+# 固定回复文本
+HELP_TEXT = """飞书日记机器人使用指南
+
+记录日记：
+直接发送文字或语音，我会引导你完成日记
+
+可用命令：
+/help - 显示帮助信息
+/diary - 整理并生成今天的日记
+/new - 开始新的日记记录
+/list - 列出所有日记文档（带删除链接）
+/query - 查询历史日记
+/delete <文档ID> - 删除指定文档
+/cleantest - 一键清除所有测试文档
+/config - 配置个人设置
+
+使用提示：
+- 直接和我聊天，我会用简短的问题引导你
+- 说完后发送 /diary 或说"整理日记"
+- 支持文字、语音、图片、视频多种格式
+- 所有日记会自动整理到飞书文档
+
+删除文档：
+- 使用 /cleantest 一键清除所有文档（最方便）
+- 或使用 /list 查看所有文档，每条记录都附带删除命令
+- 或直接发送 /delete <文档ID> 删除指定文档
+- 删除的文档会进入回收站，可恢复"""
+
+NO_DIARY_REPLY = "还没有日记记录呢，快开始记录第一篇日记吧！\n发送 /new 开始记录"
+
+DIARY_FOOTER = "\n\n提示：使用 /new 可以开始记录新的日记"
+
+QUERY_FOOTER = "提示：发送 /diary 查看今天的日记"
+
+LIST_FOOTER = "\n".join([
+    "提示：",
+    "- 点击文档链接查看完整日记",
+    "- 使用 /delete <文档ID> 删除指定文档",
+    "- 发送 /diary 查看今天的日记",
+])
+
+CLEANTEST_MANUAL_HINT = "\n".join([
+    "",
+    "部分飞书文档删除失败，请手动清理：",
+    "1. 打开飞书云文档",
+    "2. 进入'我的文档'或'与我共享'",
+    "3. 选中要删除的文档，右键删除",
+    "4. 或前往回收站彻底删除",
+])
+
+CLEANTEST_FOOTER = "\n".join([
+    "",
+    "提示：",
+    "- 所有日记记录已从数据库清除",
+    "- 删除的飞书文档已进入回收站",
+    "- 发送 /list 确认清理结果",
+])
+
+
+def _truncate(text: str, limit: int) -> str:
+    """
+    截断文本，超出长度时追加省略号
+    
+    Args:
+        text: 原文本
+        limit: 最大长度
+        
+    Returns:
+        截断后的文本
+    """
+    return text if len(text) <= limit else text[:limit] + "..."
+
 
 class TextHandler(BaseHandler):
     """文字消息处理器"""
     
-    async def handle(self, message: Dict[str, Any]) -> Dict[str, Any]:
+    # 命令 -> (处理方法名, 参数形式)
+    # 参数形式: "text" -> (user_id, text)；"chat_info" -> (user_info, chat_info)；
+    #          "user_info" -> (user_info)；None -> (user_id)
+    COMMANDS = {
+        "help": ("cmd_help", None),
+        "query": ("cmd_query", None),
+        "config": ("cmd_config", "text"),
+        "diary": ("generate_diary", "chat_info"),
+        "new": ("start_new_session", "user_info"),
+        "delete": ("cmd_delete", "text"),
+        "list": ("cmd_list", None),
+        "cleantest": ("cmd_cleantest", None),
+    }
+    
+    async def handle(self, message: Dict[str, Any], sender: Dict[str, Any]) -> Dict[str, Any]:
         """
         处理文字消息
         
         Args:
             message: 飞书文字消息数据
+            sender: 发送者信息
             
         Returns:
             处理结果
@@ -33,27 +124,27 @@ class TextHandler(BaseHandler):
             self.logger.info("=== 开始处理文字消息 ===")
             
             # 提取用户信息
-            user_info = self.extract_user_info(message)
+            user_info = self.extract_user_info(sender)
             chat_info = self.extract_chat_info(message)
-            user_id = user_info['open_id']
+            user_id = user_info.open_id
             
-            # 解析消息内容
-            content = json.loads(message.get("content", "{}"))
+            # 使用webhook已解析的消息内容
+            content = message.get("_content", {})
             text = content.get("text", "").strip()
             
-            self.logger.info("收到文字消息: " + text)
-            self.logger.info("用户: " + user_id)
+            self.logger.info("收到文字消息: %s", text)
+            self.logger.info("用户: %s", user_id)
             
             # 检查是否为命令
             if text.startswith("/"):
-                return await self.handle_command(text, user_id, chat_info)
+                return await self.handle_command(text, user_info, chat_info)
             
             # 分析用户意图
             intent = await llm_service.analyze_intent(text)
             
             # 如果是结束对话，生成日记
             if intent['should_generate_diary']:
-                return await self.generate_diary(user_id, chat_info)
+                return await self.generate_diary(user_info, chat_info)
             
             # 正常对话流程
             # 1. 保存用户消息到上下文
@@ -81,60 +172,57 @@ class TextHandler(BaseHandler):
             }
             
         except Exception as e:
-            self.logger.error("处理文字消息时出错: " + str(e))
+            self.logger.error("处理文字消息时出错: %s", e)
             return {"code": 1, "msg": "处理失败: " + str(e)}
     
-    async def handle_command(self, text: str, user_id: str, chat_info: Dict[str, str]) -> Dict[str, Any]:
+    async def handle_command(self, text: str, user_info: UserInfo, chat_info: ChatInfo) -> Dict[str, Any]:
         """
         处理命令
         
         Args:
             text: 命令文本
-            user_id: 用户ID
+            user_info: 用户信息
             chat_info: 聊天信息
             
         Returns:
             处理结果
         """
-        command = text[1:].split()[0].lower()
+        parts = text[1:].split(maxsplit=1)
+        command = parts[0].lower() if parts else ""
         
-        self.logger.info("执行命令: " + command)
+        self.logger.info("执行命令: %s", command)
         
-        if command == "help":
-            return await self.cmd_help(user_id)
-        elif command == "query":
-            return await self.cmd_query(user_id)
-        elif command == "config":
-            return await self.cmd_config(user_id, text)
-        elif command == "diary":
-            return await self.generate_diary(user_id, chat_info)
-        elif command == "new":
-            return await self.start_new_session(user_id)
-        elif command == "delete":
-            return await self.cmd_delete(user_id, text)
-        elif command == "list":
-            return await self.cmd_list(user_id)
-        elif command == "cleantest":
-            return await self.cmd_cleantest(user_id)
-        else:
+        method_name, extra_arg = self.COMMANDS.get(command, (None, None))
+        if method_name is None:
             return {"code": 1, "msg": "未知命令: " + command}
+        
+        method = getattr(self, method_name)
+        if extra_arg == "chat_info":
+            return await method(user_info, chat_info)
+        if extra_arg == "user_info":
+            return await method(user_info)
+        if extra_arg == "text":
+            return await method(user_info.open_id, text)
+        return await method(user_info.open_id)
     
-    async def generate_diary(self, user_id: str, chat_info: Dict[str, str]) -> Dict[str, Any]:
+    async def generate_diary(self, user_info: UserInfo, chat_info: ChatInfo) -> Dict[str, Any]:
         """
         生成日记
         
         Args:
-            user_id: 用户ID
+            user_info: 用户信息
             chat_info: 聊天信息
             
         Returns:
             处理结果
         """
+        user_id = user_info.open_id
         try:
-            self.logger.info("开始生成日记: user_id=" + user_id)
+            self.logger.info("开始生成日记: user_id=%s", user_id)
             
-            # 1. 获取对话上下文
-            context = conversation_service.get_context(user_id)
+            # 1. 一次获取对话上下文和媒体文件
+            context, media_files = conversation_service.get_context_and_media(user_id)
+            media_count = len(media_files)
             
             if len(context) <= 1:  # 只有系统消息，没有用户对话
                 reply = "还没有记录今天的事情呢，先和我聊聊今天发生了什么吧~"
@@ -144,82 +232,74 @@ class TextHandler(BaseHandler):
             # 2. 使用LLM生成日记
             diary_content = await llm_service.generate_diary(context)
             
-            # 3. 获取媒体文件
-            media_files = conversation_service.get_media_files(user_id)
-            
-            # 4. 保存日记到数据库
-            diary_id = str(uuid4())
-            today = datetime.now().strftime("%Y-%m-%d")
+            # 3. 保存日记到数据库
+            diary_id = uuid4().hex
+            today = today_str()
             title = "日记 - " + today
             
             # 提取摘要（前100字）
-            if len(diary_content) > 100:
-                summary = diary_content[:100] + "..."
-            else:
-                summary = diary_content
-            
-            # 提取图片信息列表（用于飞书文档）- 包含 image_key
-            image_info_list = [m for m in media_files if m.get("type") == "image"]
-
-            # 提取图片URL列表（用于数据库保存）
-            image_urls = [m.get("url") for m in media_files if m.get("type") == "image"]
-
-            # 5. 清空媒体文件记录
-            conversation_service.clear_media_files(user_id)
-
-            # 6. 创建飞书文档（传入完整的图片信息，包含 image_key）
-            doc_result = await feishu_doc_service.create_or_update_diary_document(
+            summary = _truncate(diary_content, 100)
+            
+            # 一次遍历同时提取图片信息列表（用于飞书文档，包含 image_key）
+            # 和图片URL列表（用于数据库保存）
+            image_info_list = []
+            image_urls = []
+            for m in media_files:
+                if m.get("type") == "image":
+                    image_info_list.append(m)
+                    url = m.get("url")
+                    if url:
+                        image_urls.append(url)
+
+            # 4. 创建飞书文档（传入完整的图片信息，包含 image_key），与保存数据库并行执行
+            doc_task = asyncio.create_task(feishu_doc_service.create_or_update_diary_document(
                 user_id=user_id,
                 date=today,
                 title=title,
                 content=diary_content,
                 images=image_info_list
-            )
+            ))
 
-            # 7. 保存日记到数据库（包含 document_id）
-            document_id = doc_result.get("document_id") if doc_result else None
-            save_success = diary_service.save_diary(
+            # 5. 保存日记到数据库（文档创建完成后再回填 document_id）
+            save_success = await asyncio.to_thread(
+                diary_service.save_diary,
                 diary_id=diary_id,
                 user_id=user_id,
                 title=title,
                 content=diary_content,
                 summary=summary,
                 tags=["日记", today],
-                images=image_urls,
-                document_id=document_id
+                images=image_urls
             )
 
+            doc_result = await doc_task
+            document_id = doc_result.get("document_id") if doc_result else None
+            if save_success and document_id:
+                save_success = await asyncio.to_thread(
+                    diary_service.update_document_id, diary_id, document_id
+                )
+
             if save_success:
-                self.logger.info("日记已保存: " + diary_id)
+                self.logger.info("日记已保存: %s", diary_id)
             else:
-                self.logger.error("日记保存失败: " + diary_id)
-            
-            # 7. 构建回复消息（不使用f-string，避免解析错误）
-            reply_lines = []
-            reply_lines.append("今天的日记整理好了！")
-            reply_lines.append("")
+                self.logger.error("日记保存失败: %s", diary_id)
             
+            # 6. 构建回复消息（不使用f-string，避免解析错误）
             if doc_result:
-                reply_lines.append("已保存到飞书文档：" + doc_result['url'])
-                reply_lines.append("")
+                doc_line = "已保存到飞书文档：" + doc_result['url']
             else:
-                reply_lines.append("（飞书文档保存失败，请联系管理员）")
-                reply_lines.append("")
-            
-            reply_lines.append(diary_content)
+                doc_line = "（飞书文档保存失败，请联系管理员）"
             
-            if media_files:
-                reply_lines.append("")
-                reply_lines.append("媒体文件：" + str(len(media_files)) + " 个已保存")
+            reply = "今天的日记整理好了！\n\n" + doc_line + "\n\n" + diary_content
             
-            reply_lines.append("")
-            reply_lines.append("提示：使用 /new 可以开始记录新的日记")
+            if media_count:
+                reply += "\n\n媒体文件：" + str(media_count) + " 个已保存"
             
-            reply = "\n".join(reply_lines)
+            reply += DIARY_FOOTER
             
             await message_service.send_text_message(user_id, reply)
             
-            # 8. 关闭当前会话
+            # 7. 关闭当前会话（会话中的媒体文件随之失效）
             conversation_service.close_session(user_id)
             
             return {
@@ -232,19 +312,21 @@ class TextHandler(BaseHandler):
             }
             
         except Exception as e:
-            self.logger.error("生成日记失败: " + str(e))
+            self.logger.error("生成日记失败: %s", e)
             return {"code": 1, "msg": "生成日记失败: " + str(e)}
     
-    async def start_new_session(self, user_id: str) -> Dict[str, Any]:
+    async def start_new_session(self, user_info: UserInfo) -> Dict[str, Any]:
         """
         开始新的日记会话
         
         Args:
-            user_id: 用户ID
+            user_info: 用户信息
             
         Returns:
             处理结果
         """
+        user_id = user_info.open_id
+        
         # 关闭旧会话
         conversation_service.close_session(user_id)
         
@@ -266,67 +348,30 @@ class TextHandler(BaseHandler):
     
     async def cmd_help(self, user_id: str) -> Dict[str, Any]:
         """帮助命令"""
-        help_text = """飞书日记机器人使用指南
-
-记录日记：
-直接发送文字或语音，我会引导你完成日记
-
-可用命令：
-/help - 显示帮助信息
-/diary - 整理并生成今天的日记
-/new - 开始新的日记记录
-/list - 列出所有日记文档（带删除链接）
-/query - 查询历史日记
-/delete <文档ID> - 删除指定文档
-/cleantest - 一键清除所有测试文档
-/config - 配置个人设置
-
-使用提示：
-- 直接和我聊天，我会用简短的问题引导你
-- 说完后发送 /diary 或说"整理日记"
-- 支持文字、语音、图片、视频多种格式
-- 所有日记会自动整理到飞书文档
-
-删除文档：
-- 使用 /cleantest 一键清除所有文档（最方便）
-- 或使用 /list 查看所有文档，每条记录都附带删除命令
-- 或直接发送 /delete <文档ID> 删除指定文档
-- 删除的文档会进入回收站，可恢复"""
-        
-        await message_service.send_text_message(user_id, help_text)
+        await message_service.send_text_message(user_id, HELP_TEXT)
         return {"code": 0, "msg": "帮助信息已发送"}
     
     async def cmd_query(self, user_id: str) -> Dict[str, Any]:
         """查询日记命令"""
         try:
             # 获取最近的5篇日记
-            diaries = diary_service.get_diaries_by_user(user_id, limit=5)
+            diaries = await asyncio.to_thread(diary_service.get_diaries_by_user, user_id, limit=5)
             
             if not diaries:
-                reply = "还没有日记记录呢，快开始记录第一篇日记吧！\n发送 /new 开始记录"
-                await message_service.send_text_message(user_id, reply)
+                await message_service.send_text_message(user_id, NO_DIARY_REPLY)
                 return {"code": 0, "msg": "无日记记录"}
             
             # 构建日记列表
-            reply_lines = ["最近的日记：", ""]
-            for i, diary in enumerate(diaries, 1):
-                date = diary['create_date']
-                if len(diary['summary']) > 50:
-                    summary = diary['summary'][:50] + "..."
-                else:
-                    summary = diary['summary']
-                reply_lines.append(str(i) + ". " + date)
-                reply_lines.append("   " + summary)
-                reply_lines.append("")
-            
-            reply_lines.append("提示：发送 /diary 查看今天的日记")
-            reply = "\n".join(reply_lines)
+            reply = "最近的日记：\n\n" + "".join(
+                str(i) + ". " + diary['create_date'] + "\n   " + _truncate(diary['summary'], 50) + "\n\n"
+                for i, diary in enumerate(diaries, 1)
+            ) + QUERY_FOOTER
             
             await message_service.send_text_message(user_id, reply)
             return {"code": 0, "msg": "日记列表已发送"}
             
         except Exception as e:
-            self.logger.error("查询日记失败: " + str(e))
+            self.logger.error("查询日记失败: %s", e)
             reply = "查询日记时出错，请稍后再试"
             await message_service.send_text_message(user_id, reply)
             return {"code": 1, "msg": "查询失败: " + str(e)}
@@ -343,54 +388,50 @@ class TextHandler(BaseHandler):
         """
         try:
             # 获取用户的日记列表
-            diaries = diary_service.get_diaries_by_user(user_id, limit=20)
+            diaries = await asyncio.to_thread(diary_service.get_diaries_by_user, user_id, limit=20)
 
             if not diaries:
-                reply = "还没有日记记录呢，快开始记录第一篇日记吧！\n发送 /new 开始记录"
-                await message_service.send_text_message(user_id, reply)
+                await message_service.send_text_message(user_id, NO_DIARY_REPLY)
                 return {"code": 0, "msg": "无日记记录"}
 
             # 构建日记列表
-            reply_lines = ["你的日记列表：", ""]
-
-            for i, diary in enumerate(diaries, 1):
-                date = diary.get('create_date', '未知日期')
-                title = diary.get('title', '无标题')
-                document_id = diary.get('document_id', '')
-
-                # 显示摘要（前30字）
-                summary = diary.get('summary', '')
-                if len(summary) > 30:
-                    summary = summary[:30] + "..."
-
-                reply_lines.append(f"{i}. {date} - {title}")
-                reply_lines.append(f"   摘要: {summary}")
-
-                if document_id:
-                    doc_url = f"https://www.feishu.cn/docx/{document_id}"
-                    reply_lines.append(f"   文档: {doc_url}")
-                    reply_lines.append(f"   删除: /delete {document_id}")
-                else:
-                    reply_lines.append(f"   文档: 未生成飞书文档")
-
-                reply_lines.append("")
-
-            reply_lines.append("提示：")
-            reply_lines.append("- 点击文档链接查看完整日记")
-            reply_lines.append("- 使用 /delete <文档ID> 删除指定文档")
-            reply_lines.append("- 发送 /diary 查看今天的日记")
-
-            reply = "\n".join(reply_lines)
+            reply = "你的日记列表：\n\n" + "\n\n".join(
+                self._format_list_entry(i, diary) for i, diary in enumerate(diaries, 1)
+            ) + "\n\n" + LIST_FOOTER
 
             await message_service.send_text_message(user_id, reply)
             return {"code": 0, "msg": "日记列表已发送"}
 
         except Exception as e:
-            self.logger.error(f"列出日记失败: {e}")
+            self.logger.error("列出日记失败: %s", e)
             reply = "获取日记列表时出错，请稍后再试"
             await message_service.send_text_message(user_id, reply)
             return {"code": 1, "msg": f"列出日记失败: {str(e)}"}
 
+    def _format_list_entry(self, index: int, diary: Dict[str, Any]) -> str:
+        """
+        格式化日记列表中的一条记录
+
+        Args:
+            index: 序号
+            diary: 日记信息
+
+        Returns:
+            格式化后的文本
+        """
+        create_date = diary.get('create_date', '未知日期')
+        title = diary.get('title', '无标题')
+        document_id = diary.get('document_id', '')
+
+        # 显示摘要（前30字）
+        summary = _truncate(diary.get('summary') or '', 30)
+
+        entry = f"{index}. {create_date} - {title}\n   摘要: {summary}\n"
+        if document_id:
+            doc_url = DOC_URL_PREFIX + document_id
+            return entry + f"   文档: {doc_url}\n   删除: /delete {document_id}"
+        return entry + "   文档: 未生成飞书文档"
+
     async def cmd_cleantest(self, user_id: str) -> Dict[str, Any]:
         """
         清除所有测试文档
@@ -398,7 +439,7 @@ class TextHandler(BaseHandler):
         """
         try:
             # 获取用户的所有日记
-            diaries = diary_service.get_diaries_by_user(user_id, limit=1000)
+            diaries = await asyncio.to_thread(diary_service.get_diaries_by_user, user_id, limit=1000)
 
             if not diaries:
                 reply = "没有需要清理的文档"
@@ -406,28 +447,30 @@ class TextHandler(BaseHandler):
                 return {"code": 0, "msg": "无文档需要清理"}
 
             total_count = len(diaries)
-            doc_deleted_count = 0
-            doc_failed_count = 0
-            no_doc_count = 0
 
-            # 发送开始清理的消息
-            reply = f"开始清理，共 {total_count} 条日记记录..."
-            await message_service.send_text_message(user_id, reply)
+            # 发送开始清理的消息（与删除并行发送，不阻塞清理）
+            announce_task = asyncio.create_task(
+                message_service.send_text_message(user_id, f"开始清理，共 {total_count} 条日记记录...")
+            )
 
-            # 遍历删除所有文档（飞书文档）
-            for diary in diaries:
-                document_id = diary.get('document_id')
-                if document_id:
-                    success = await feishu_doc_service.delete_document(document_id)
-                    if success:
-                        doc_deleted_count += 1
-                    else:
-                        doc_failed_count += 1
-                else:
-                    no_doc_count += 1
+            # 只对有飞书文档的记录发起删除
+            document_ids = [diary['document_id'] for diary in diaries if diary.get('document_id')]
+            no_doc_count = total_count - len(document_ids)
+
+            # 并发删除所有文档（飞书文档）
+            async def delete_one_document(document_id: str) -> bool:
+                async with _doc_delete_semaphore:
+                    return await feishu_doc_service.delete_document(document_id)
+
+            results = await asyncio.gather(
+                *[delete_one_document(document_id) for document_id in document_ids],
+                return_exceptions=True
+            )
+            doc_deleted_count = sum(1 for r in results if r is True)
+            doc_failed_count = len(document_ids) - doc_deleted_count
 
             # 删除数据库记录
-            db_deleted_count = diary_service.delete_diaries_by_user(user_id)
+            db_deleted_count = await asyncio.to_thread(diary_service.delete_diaries_by_user, user_id)
 
             # 构建结果消息
             reply_lines = ["清理完成！", ""]
@@ -438,27 +481,21 @@ class TextHandler(BaseHandler):
             reply_lines.append(f"数据库记录清理: {db_deleted_count} 条")
 
             if doc_failed_count > 0:
-                reply_lines.append("")
-                reply_lines.append("部分飞书文档删除失败，请手动清理：")
-                reply_lines.append("1. 打开飞书云文档")
-                reply_lines.append("2. 进入'我的文档'或'与我共享'")
-                reply_lines.append("3. 选中要删除的文档，右键删除")
-                reply_lines.append("4. 或前往回收站彻底删除")
-
-            reply_lines.append("")
-            reply_lines.append("提示：")
-            reply_lines.append("- 所有日记记录已从数据库清除")
-            reply_lines.append("- 删除的飞书文档已进入回收站")
-            reply_lines.append("- 发送 /list 确认清理结果")
+                reply_lines.append(CLEANTEST_MANUAL_HINT)
+
+            reply_lines.append(CLEANTEST_FOOTER)
 
             reply = "\n".join(reply_lines)
+
+            # 确保开始消息先于结果消息送达
+            await announce_task
             await message_service.send_text_message(user_id, reply)
 
-            self.logger.info(f"用户 {user_id} 清理完成: 总计{total_count}, 文档删除{doc_deleted_count}, 失败{doc_failed_count}, 数据库清理{db_deleted_count}")
+            self.logger.info("用户 %s 清理完成: 总计%s, 文档删除%s, 失败%s, 数据库清理%s", user_id, total_count, doc_deleted_count, doc_failed_count, db_deleted_count)
             return {"code": 0, "msg": f"清理完成"}
 
         except Exception as e:
-            self.logger.error(f"清理文档失败: {e}")
+            self.logger.error("清理文档失败: %s", e)
             reply = "清理文档时出错，请稍后再试"
             await message_service.send_text_message(user_id, reply)
             return {"code": 1, "msg": f"清理文档失败: {str(e)}"}
@@ -484,22 +521,15 @@ class TextHandler(BaseHandler):
                 await message_service.send_text_message(user_id, reply)
                 return {"code": 1, "msg": "文档ID为空"}
 
-            self.logger.info(f"用户 {user_id} 请求删除文档: {document_id}")
+            self.logger.info("用户 %s 请求删除文档: %s", user_id, document_id)
+
+            # 1. 调用删除文档API（飞书文档），与数据库删除并行执行
+            doc_task = asyncio.create_task(feishu_doc_service.delete_document(document_id))
 
-            # 1. 调用删除文档API（飞书文档）
-            doc_success = await feishu_doc_service.delete_document(document_id)
+            # 2. 一条SQL删除数据库中关联的日记记录
+            db_deleted_count = await asyncio.to_thread(diary_service.delete_by_document_id, document_id)
 
-            # 2. 删除数据库中关联的日记记录
-            diaries = diary_service.get_diaries_by_document_id(document_id)
-            db_deleted_count = 0
-            if diaries:
-                for diary in diaries:
-                    diary_id = diary.get('id')
-                    if diary_id:
-                        success = diary_service.delete_diary(diary_id)
-                        if success:
-                            db_deleted_count += 1
-                            self.logger.info(f"数据库日记记录已删除: {diary_id}")
+            doc_success = await doc_task
 
             # 构建回复消息
             if doc_success:
@@ -522,7 +552,7 @@ class TextHandler(BaseHandler):
                 return {"code": 1, "msg": "文档删除失败"}
 
         except Exception as e:
-            self.logger.error(f"删除文档命令失败: {e}")
+            self.logger.error("删除文档命令失败: %s", e)
             reply = "删除文档时出错，请稍后重试"
             await message_service.send_text_message(user_id, reply)
             return {"code": 1, "msg": f"删除文档失败: {str(e)}"}
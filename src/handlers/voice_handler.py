@@ -3,31 +3,31 @@
 处理用户发送的语音消息，调用飞书语音识别API转换为文字
 """
 
-import json
 from typing import Dict, Any
 from .base_handler import BaseHandler
-from src.bot.client import feishu_client
+from src.bot.client import get_client
 
 
 class VoiceHandler(BaseHandler):
     """语音消息处理器"""
     
-    async def handle(self, message: Dict[str, Any]) -> Dict[str, Any]:
+    async def handle(self, message: Dict[str, Any], sender: Dict[str, Any]) -> Dict[str, Any]:
         """
         处理语音消息
         
         Args:
             message: 飞书语音消息数据
+            sender: 发送者信息
             
         Returns:
             处理结果
         """
         try:
             # 提取用户信息
-            user_info = self.extract_user_info(message)
+            user_info = self.extract_user_info(sender)
             chat_info = self.extract_chat_info(message)
             
-            self.logger.info(f"收到语音消息，用户: {user_info['open_id']}")
+            self.logger.info("收到语音消息，用户: %s", user_info.open_id)
             
             # TODO: 实现语音识别逻辑
             # 1. 获取语音文件URL
@@ -40,13 +40,13 @@ class VoiceHandler(BaseHandler):
                 "code": 0,
                 "msg": "语音消息已接收，正在处理中...",
                 "data": {
-                    "user_id": user_info["open_id"],
-                    "message_id": chat_info["message_id"]
+                    "user_id": user_info.open_id,
+                    "message_id": chat_info.message_id
                 }
             }
             
         except Exception as e:
-            self.logger.error(f"处理语音消息时出错: {e}")
+            self.logger.error("处理语音消息时出错: %s", e)
             return {"code": 1, "msg": f"语音处理失败: {str(e)}"}
     
     async def recognize_voice(self, file_key: str) -> str:
@@ -4,24 +4,24 @@
 """
 
 from datetime import datetime
+from time import time
 from typing import Optional, List
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field, field_serializer
 from uuid import uuid4
 
 
 class Diary(BaseModel):
     """日记模型"""
     
-    id: str = Field(default_factory=lambda: str(uuid4()))
+    model_config = ConfigDict(from_attributes=True)
+    
+    id: str = Field(default_factory=lambda: uuid4().hex)
     user_id: str
     content: str
-    create_time: datetime = Field(default_factory=datetime.now)
-    update_time: datetime = Field(default_factory=datetime.now)
+    create_time: int = Field(default_factory=lambda: int(time()))  # Unix时间戳（秒）
+    update_time: int = Field(default_factory=lambda: int(time()))
     category: Optional[str] = None
     document_url: Optional[str] = None
-    
-    class Config:
-        from_attributes = True
 
 
 class DiaryCreate(BaseModel):
@@ -43,6 +43,11 @@ class DiaryResponse(BaseModel):
     id: str
     user_id: str
     content: str
-    create_time: datetime
+    create_time: int
     category: Optional[str] = None
     document_url: Optional[str] = None
+
+    @field_serializer("create_time")
+    def _serialize_create_time(self, value: int) -> str:
+        """响应中以ISO格式输出时间"""
+        return datetime.fromtimestamp(value).isoformat()
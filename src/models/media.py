@@ -4,23 +4,23 @@
 """
 
 from datetime import datetime
+from time import time
 from typing import Optional
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field, field_serializer
 from uuid import uuid4
 
 
 class Media(BaseModel):
     """媒体文件模型"""
     
-    id: str = Field(default_factory=lambda: str(uuid4()))
+    model_config = ConfigDict(from_attributes=True)
+    
+    id: str = Field(default_factory=lambda: uuid4().hex)
     diary_id: str
     file_name: str
     file_type: str  # image, video
     file_url: str
-    upload_time: datetime = Field(default_factory=datetime.now)
-    
-    class Config:
-        from_attributes = True
+    upload_time: int = Field(default_factory=lambda: int(time()))  # Unix时间戳（秒）
 
 
 class MediaCreate(BaseModel):
@@ -38,4 +38,9 @@ class MediaResponse(BaseModel):
     file_name: str
     file_type: str
     file_url: str
-    upload_time: datetime
+    upload_time: int
+
+    @field_serializer("upload_time")
+    def _serialize_upload_time(self, value: int) -> str:
+        """响应中以ISO格式输出时间"""
+        return datetime.fromtimestamp(value).isoformat()
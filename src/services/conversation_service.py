@@ -3,11 +3,36 @@
 管理用户的对话历史和状态
 """
 
-import json
-from typing import List, Dict, Any, Optional
+import os
+import orjson
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import List, Dict, Any, Optional, Tuple
 from datetime import datetime, timedelta
+from src.utils.config import settings
 from src.utils.database import db
 from src.utils.logger import logger
+from src.utils.timeutil import today_str, now_iso
+
+# 会话初始的系统消息
+SYSTEM_PROMPT = "你是一个贴心的日记助手。帮助用户记录今天的事情，用简短的问题引导对话，适度追问细节，最后整理成完整的日记。"
+
+# 会话保留全部系统消息和最近的 MAX_RECENT_MESSAGES 条对话消息（避免上下文过长）
+MAX_RECENT_MESSAGES = 18
+
+# 进程内活跃会话缓存的最大用户数（LRU淘汰）
+SESSION_CACHE_SIZE = 1000
+
+
+def _is_multi_process() -> bool:
+    """
+    是否为多进程部署：配置了 REDIS_URL（多 worker 部署必须配置，用于跨进程去重），
+    或 WEB_CONCURRENCY 指定了多个 uvicorn worker
+    """
+    workers = os.environ.get("WEB_CONCURRENCY", "")
+    return bool(settings.redis_url) or (workers.isdigit() and int(workers) > 1)
 
 
 class ConversationService:
@@ -15,32 +40,51 @@ class ConversationService:
     
     def __init__(self):
         """初始化对话服务"""
+        # user_id -> {"id", "session_date", "system", "tail", "system_ctx", "tail_ctx", "media_files"}，写入时就地更新
+        # system 为系统消息列表，tail 为 deque(maxlen=MAX_RECENT_MESSAGES)，追加时自动淘汰最旧的消息；
+        # *_ctx 是同步维护的LLM格式（只有role/content），get_context 无需逐条重建字典
+        self._session_cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._session_lock = threading.RLock()
+        # 多进程部署时其他进程的写入在本进程缓存中不可见，关闭缓存，每次读取都从数据库加载
+        self._cache_enabled = not _is_multi_process()
+        if not self._cache_enabled:
+            logger.info("多进程部署，已关闭进程内会话缓存")
         self._init_table()
+        
+        # 单写线程：消息/媒体写入先更新缓存再入队，由专用连接顺序提交，请求路径不等待fsync
+        # 队列元素为 (用户ID, 会话ID, 新消息列表, 新媒体列表, 是否先清空媒体)
+        self._write_queue: queue.Queue = queue.Queue()
+        # user_id -> 已入队但尚未提交的写入数，从数据库加载会话前只等待该用户自己的写入
+        self._pending: Dict[str, int] = {}
+        self._pending_cond = threading.Condition()
+        self._writer = threading.Thread(target=self._writer_loop, name="conversation-writer", daemon=True)
+        self._writer.start()
     
     def _init_table(self):
         """初始化对话记录表"""
         try:
             with db.get_connection() as conn:
                 cursor = conn.cursor()
-                # 检查表是否存在
-                cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='conversation'")
-                table_exists = cursor.fetchone()
+                # 整个建表/迁移过程放在一个事务里，只提交一次
+                cursor.execute("BEGIN")
+                cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
+                existing_tables = {row[0] for row in cursor.fetchall()}
                 
-                if not table_exists:
-                    # 创建新表
-                    cursor.execute("""
-                        CREATE TABLE conversation (
-                            id INTEGER PRIMARY KEY AUTOINCREMENT,
-                            user_id TEXT NOT NULL,
-                            session_date TEXT NOT NULL,
-                            messages TEXT NOT NULL,
-                            media_files TEXT DEFAULT '[]',
-                            status TEXT DEFAULT 'active',
-                            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                        )
-                    """)
-                else:
+                # messages 列仅为兼容旧数据保留，消息存放在 conversation_messages 表
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS conversation (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        user_id TEXT NOT NULL,
+                        session_date TEXT NOT NULL,
+                        messages TEXT NOT NULL,
+                        media_files TEXT DEFAULT '[]',
+                        status TEXT DEFAULT 'active',
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    )
+                """)
+                
+                if 'conversation' in existing_tables:
                     # 检查是否需要添加 media_files 列
                     cursor.execute("PRAGMA table_info(conversation)")
                     columns = [col[1] for col in cursor.fetchall()]
@@ -48,108 +92,344 @@ class ConversationService:
                     if 'media_files' not in columns:
                         cursor.execute("ALTER TABLE conversation ADD COLUMN media_files TEXT DEFAULT '[]'")
                 
+                # 每条消息都会按 用户+日期 查找活跃会话；部分索引只包含活跃会话，已关闭的会话不占索引空间
+                cursor.execute("DROP INDEX IF EXISTS idx_conv_user_date_status")
+                cursor.execute(
+                    "CREATE INDEX IF NOT EXISTS idx_conv_active ON conversation(user_id, session_date) WHERE status = 'active'"
+                )
+                
+                # 消息表：每条消息一行，追加只需插入一行，无需整体序列化会话
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS conversation_messages (
+                        session_id INTEGER NOT NULL,
+                        seq INTEGER NOT NULL,
+                        role TEXT NOT NULL,
+                        content TEXT NOT NULL,
+                        ts REAL,
+                        PRIMARY KEY (session_id, seq)
+                    )
+                """)
+                if 'conversation_messages' not in existing_tables:
+                    self._migrate_active_messages(cursor)
+                
+                # 媒体表：每个媒体文件一行，添加媒体只需插入一行
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS conversation_media (
+                        session_id INTEGER NOT NULL,
+                        seq INTEGER NOT NULL,
+                        info TEXT NOT NULL,
+                        added_at TEXT,
+                        PRIMARY KEY (session_id, seq)
+                    )
+                """)
+                if 'conversation_media' not in existing_tables:
+                    # 把活跃会话 media_files JSON 中的媒体迁移到新表
+                    cursor.execute("""
+                        INSERT INTO conversation_media (session_id, seq, info, added_at)
+                        SELECT c.id, CAST(j.key AS INTEGER) + 1, j.value, json_extract(j.value, '$.added_at')
+                        FROM conversation c, json_each(c.media_files) j
+                        WHERE c.status = 'active' AND json_valid(c.media_files)
+                    """)
+                
                 conn.commit()
                 logger.info("对话记录表初始化完成")
         except Exception as e:
             logger.error(f"初始化对话表失败: {e}")
     
-    def get_or_create_session(self, user_id: str) -> Dict[str, Any]:
+    def _migrate_active_messages(self, cursor) -> None:
         """
-        获取或创建今天的对话会话
+        把旧版本存放在 conversation.messages JSON 中的活跃会话消息迁移到 conversation_messages 表
         
         Args:
+            cursor: 数据库游标
+        """
+        cursor.execute("SELECT id, messages FROM conversation WHERE status = 'active'")
+        rows = []
+        for session_id, messages_json in cursor.fetchall():
+            for seq, msg in enumerate(orjson.loads(messages_json or '[]'), start=1):
+                try:
+                    ts = datetime.fromisoformat(msg['timestamp']).timestamp()
+                except (KeyError, TypeError, ValueError):
+                    ts = None
+                rows.append((session_id, seq, msg['role'], msg['content'], ts))
+        
+        if rows:
+            cursor.executemany(
+                "INSERT INTO conversation_messages (session_id, seq, role, content, ts) VALUES (?, ?, ?, ?, ?)",
+                rows
+            )
+            logger.info(f"已迁移 {len(rows)} 条会话消息")
+    
+    def _get_or_create_session_tx(self, cursor, user_id: str) -> Tuple[int, str]:
+        """
+        在当前事务内获取今天的活跃会话，不存在或已过期（超过24小时）则创建新会话
+        查询前以 BEGIN IMMEDIATE 取得写锁，多个进程同时未命中时查询和创建串行执行，不会各自创建活跃会话
+        
+        Args:
+            cursor: 数据库游标
             user_id: 用户ID
             
         Returns:
-            会话信息
+            (会话ID, 会话日期)
         """
-        today = datetime.now().strftime("%Y-%m-%d")
+        if not cursor.connection.in_transaction:
+            cursor.execute("BEGIN IMMEDIATE")
+        today = today_str()
+        cursor.execute(
+            "SELECT id, updated_at FROM conversation WHERE user_id = ? AND session_date = ? AND status = 'active'",
+            (user_id, today)
+        )
+        row = cursor.fetchone()
         
-        try:
-            # 查询今天的会话
-            result = db.fetch_one(
-                "SELECT * FROM conversation WHERE user_id = ? AND session_date = ? AND status = 'active'",
-                (user_id, today)
+        if row:
+            session_id, updated_at = row
+            # 检查会话是否过期（超过24小时）
+            if datetime.now() - datetime.fromisoformat(updated_at) <= timedelta(hours=24):
+                return session_id, today
+            # 关闭旧会话
+            cursor.execute("UPDATE conversation SET status = 'closed' WHERE id = ?", (session_id,))
+        
+        # 创建新会话并写入系统消息
+        cursor.execute(
+            "INSERT INTO conversation (user_id, session_date, messages, media_files, status) "
+            "VALUES (?, ?, '[]', '[]', 'active') RETURNING id",
+            (user_id, today)
+        )
+        session_id = cursor.fetchone()[0]
+        self._insert_message(cursor, session_id, {
+            "role": "system", "content": SYSTEM_PROMPT, "timestamp": time.time()
+        })
+        
+        logger.info(f"创建新会话: user_id={user_id}, session_id={session_id}")
+        return session_id, today
+    
+    def _insert_message(self, cursor, session_id: int, message: Dict[str, str]) -> None:
+        """
+        追加一条消息，并裁剪到最近 MAX_RECENT_MESSAGES 条对话消息（保留系统消息）
+        
+        Args:
+            cursor: 数据库游标
+            session_id: 会话ID
+            message: 消息（role/content/timestamp，timestamp 为Unix时间戳）
+        """
+        cursor.execute(
+            "INSERT INTO conversation_messages (session_id, seq, role, content, ts) "
+            "VALUES (?, (SELECT COALESCE(MAX(seq), 0) + 1 FROM conversation_messages WHERE session_id = ?), ?, ?, ?)",
+            (session_id, session_id, message["role"], message["content"], message["timestamp"])
+        )
+        
+        if message["role"] != 'system':
+            cursor.execute(
+                "DELETE FROM conversation_messages WHERE session_id = ? AND role != 'system' AND seq NOT IN "
+                "(SELECT seq FROM conversation_messages WHERE session_id = ? AND role != 'system' ORDER BY seq DESC LIMIT ?)",
+                (session_id, session_id, MAX_RECENT_MESSAGES)
             )
+    
+    def _writer_loop(self) -> None:
+        """写线程：使用专用连接按入队顺序提交会话写入，收到 None 时退出"""
+        conn = db.get_connection()
+        while True:
+            job = self._write_queue.get()
+            if job is None:
+                self._write_queue.task_done()
+                break
             
-            if result:
-                # 检查会话是否过期（超过24小时）
-                updated_at = datetime.fromisoformat(result['updated_at'])
-                if datetime.now() - updated_at > timedelta(hours=24):
-                    # 关闭旧会话
-                    self.close_session(user_id)
-                    # 创建新会话
-                    return self._create_new_session(user_id, today)
-                
-                # 返回现有会话
-                return {
-                    "id": result['id'],
-                    "user_id": result['user_id'],
-                    "session_date": result['session_date'],
-                    "messages": json.loads(result['messages']),
-                    "media_files": json.loads(result.get('media_files', '[]')),
-                    "status": result['status']
-                }
-            else:
-                # 创建新会话
-                return self._create_new_session(user_id, today)
-                
-        except Exception as e:
-            logger.error(f"获取会话失败: {e}")
-            return self._create_new_session(user_id, today)
+            user_id, session_id, new_messages, new_media, clear_media = job
+            try:
+                with conn:
+                    cursor = conn.cursor()
+                    for message in new_messages:
+                        self._insert_message(cursor, session_id, message)
+                    
+                    if clear_media:
+                        cursor.execute("DELETE FROM conversation_media WHERE session_id = ?", (session_id,))
+                    for media_info in new_media:
+                        cursor.execute(
+                            "INSERT INTO conversation_media (session_id, seq, info, added_at) "
+                            "VALUES (?, (SELECT COALESCE(MAX(seq), 0) + 1 FROM conversation_media WHERE session_id = ?), ?, ?)",
+                            (session_id, session_id, orjson.dumps(media_info).decode(), media_info.get('added_at'))
+                        )
+                    
+                    cursor.execute(
+                        "UPDATE conversation SET updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+                        (session_id,)
+                    )
+            except Exception as e:
+                logger.error(f"写入会话失败: user_id={user_id}, session_id={session_id}, {e}")
+                # 缓存已包含这次未写入的修改，淘汰后下次读取从数据库重新加载，避免缓存与数据库不一致
+                with self._session_lock:
+                    cached = self._session_cache.get(user_id)
+                    if cached is not None and cached['id'] == session_id:
+                        del self._session_cache[user_id]
+            finally:
+                with self._pending_cond:
+                    remaining = self._pending[user_id] - 1
+                    if remaining:
+                        self._pending[user_id] = remaining
+                    else:
+                        del self._pending[user_id]
+                        self._pending_cond.notify_all()
+                self._write_queue.task_done()
+        conn.close()
+    
+    def _wait_pending(self, user_id: str) -> None:
+        """
+        等待该用户已入队的写入全部提交（不等待其他用户的写入）
+        
+        Args:
+            user_id: 用户ID
+        """
+        with self._pending_cond:
+            while self._pending.get(user_id):
+                self._pending_cond.wait()
     
-    def _create_new_session(self, user_id: str, session_date: str) -> Dict[str, Any]:
+    def close(self) -> None:
+        """等待写队列中剩余的写入提交完成并停止写线程（应用关闭时调用）"""
+        self._write_queue.put(None)
+        self._writer.join()
+    
+    def _load_session(self, user_id: str) -> Dict[str, Any]:
         """
-        创建新会话
+        获取今天的活跃会话，优先使用进程内缓存（多进程部署时关闭），未命中或跨天时从数据库加载
+        （会话按天创建，同一天内的会话不会超过24小时过期，跨天检查即覆盖过期检查）
         
         Args:
             user_id: 用户ID
-            session_date: 会话日期
             
         Returns:
-            新会话信息
+            缓存的会话（调用方不得修改）
         """
-        # 初始化系统消息
-        initial_messages = [
-            {
-                "role": "system",
-                "content": "你是一个贴心的日记助手。帮助用户记录今天的事情，用简短的问题引导对话，适度追问细节，最后整理成完整的日记。"
-            }
-        ]
+        today = today_str()
+        if self._cache_enabled:
+            with self._session_lock:
+                session = self._session_cache.get(user_id)
+                if session is not None:
+                    if session['session_date'] == today:
+                        self._session_cache.move_to_end(user_id)
+                        return session
+                    del self._session_cache[user_id]
+        
+        # 缓存未命中：先等待该用户尚未提交的写入落盘，避免读到旧数据
+        self._wait_pending(user_id)
+        
+        with db.get_connection() as conn:
+            cursor = conn.cursor()
+            session_id, session_date = self._get_or_create_session_tx(cursor, user_id)
+            cursor.execute(
+                "SELECT role, content, ts FROM conversation_messages WHERE session_id = ? ORDER BY seq",
+                (session_id,)
+            )
+            rows = cursor.fetchall()
+            cursor.execute(
+                "SELECT info FROM conversation_media WHERE session_id = ? ORDER BY seq",
+                (session_id,)
+            )
+            media_files = [orjson.loads(info) for (info,) in cursor.fetchall()]
+            conn.commit()
+        
+        session = {
+            "id": session_id,
+            "session_date": session_date,
+            "system": [],
+            "tail": deque(maxlen=MAX_RECENT_MESSAGES),
+            "system_ctx": [],
+            "tail_ctx": deque(maxlen=MAX_RECENT_MESSAGES),
+            "media_files": media_files
+        }
+        for role, content, ts in rows:
+            self._append_cached(session, {"role": role, "content": content, "timestamp": ts})
         
-        initial_media = []
+        if self._cache_enabled:
+            with self._session_lock:
+                self._session_cache[user_id] = session
+                if len(self._session_cache) > SESSION_CACHE_SIZE:
+                    self._session_cache.popitem(last=False)
+        return session
+    
+    def _append_cached(self, session: Dict[str, Any], message: Dict[str, Any]) -> None:
+        """
+        把消息追加到缓存的会话（完整消息和LLM格式各一份）
+        
+        Args:
+            session: 缓存的会话
+            message: 消息（role/content/timestamp）
+        """
+        if message['role'] == 'system':
+            session['system'].append(message)
+            session['system_ctx'].append({"role": message['role'], "content": message['content']})
+        else:
+            session['tail'].append(message)
+            session['tail_ctx'].append({"role": message['role'], "content": message['content']})
+    
+    def get_or_create_session(self, user_id: str) -> Dict[str, Any]:
+        """
+        获取或创建今天的对话会话
         
+        Args:
+            user_id: 用户ID
+            
+        Returns:
+            会话信息
+        """
         try:
-            with db.get_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute(
-                    "INSERT INTO conversation (user_id, session_date, messages, media_files, status) VALUES (?, ?, ?, ?, 'active')",
-                    (user_id, session_date, json.dumps(initial_messages), json.dumps(initial_media))
-                )
-                conn.commit()
-                session_id = cursor.lastrowid
-                
-                logger.info(f"创建新会话: user_id={user_id}, session_id={session_id}")
+            session = self._load_session(user_id)
+            with self._session_lock:
+                messages = session['system'] + list(session['tail'])
+                media_files = list(session['media_files'])
+            return {
+                "id": session['id'],
+                "user_id": user_id,
+                "session_date": session['session_date'],
+                "messages": messages,
+                "media_files": media_files,
+                "status": "active"
+            }
                 
-                return {
-                    "id": session_id,
-                    "user_id": user_id,
-                    "session_date": session_date,
-                    "messages": initial_messages,
-                    "media_files": initial_media,
-                    "status": "active"
-                }
         except Exception as e:
-            logger.error(f"创建会话失败: {e}")
+            logger.error(f"获取会话失败: {e}")
             return {
                 "id": None,
                 "user_id": user_id,
-                "session_date": session_date,
-                "messages": initial_messages,
-                "media_files": initial_media,
+                "session_date": today_str(),
+                "messages": [{"role": "system", "content": SYSTEM_PROMPT}],
+                "media_files": [],
                 "status": "active"
             }
     
+    def _modify_session(self, user_id: str, new_messages: List[Tuple[str, str]] = (),
+                        new_media: List[Dict[str, Any]] = (), clear_media: bool = False) -> None:
+        """
+        向今天的会话追加消息和/或修改媒体文件
+        先更新进程内缓存（后续读取立即可见），再交给写线程异步提交到数据库；
+        会话不存在或已过期时由 _load_session 创建新会话
+        
+        Args:
+            user_id: 用户ID
+            new_messages: 要追加的 (role, content) 列表
+            new_media: 要追加的媒体信息列表
+            clear_media: 是否先清空已有的媒体文件
+        """
+        session = self._load_session(user_id)
+        # 消息时间以Unix时间戳保存，需要展示时再转换为ISO格式
+        timestamp = time.time()
+        messages = [{"role": role, "content": content, "timestamp": timestamp} for role, content in new_messages]
+        
+        new_media = list(new_media)
+        with self._session_lock:
+            for message in messages:
+                self._append_cached(session, message)
+            if clear_media:
+                session['media_files'] = []
+            if new_media:
+                session['media_files'] = session['media_files'] + new_media
+        
+        with self._pending_cond:
+            self._pending[user_id] = self._pending.get(user_id, 0) + 1
+        self._write_queue.put((user_id, session['id'], messages, new_media, clear_media))
+        if not self._cache_enabled:
+            # 没有缓存时等待提交完成，保证其他进程随后读取到这次写入
+            self._wait_pending(user_id)
+    
     def add_message(self, user_id: str, role: str, content: str) -> bool:
         """
         添加消息到会话
@@ -163,37 +443,48 @@ class ConversationService:
             是否成功
         """
         try:
-            session = self.get_or_create_session(user_id)
-            messages = session['messages']
+            self._modify_session(user_id, [(role, content)])
             
-            # 添加新消息
-            messages.append({
-                "role": role,
-                "content": content,
-                "timestamp": datetime.now().isoformat()
-            })
+            logger.info(f"添加消息: user_id={user_id}, role={role}")
+            return True
             
-            # 只保留最近20条消息（避免过长）
-            if len(messages) > 20:
-                # 保留系统消息和最近的消息
-                system_messages = [m for m in messages if m['role'] == 'system']
-                other_messages = [m for m in messages if m['role'] != 'system'][-18:]
-                messages = system_messages + other_messages
+        except Exception as e:
+            logger.error(f"添加消息失败: {e}")
+            return False
+    
+    def add_turn(self, user_id: str, media_info: Optional[Dict[str, Any]] = None,
+                 user_message: Optional[str] = None, assistant_message: Optional[str] = None) -> bool:
+        """
+        一次性写入一轮对话（媒体信息、用户消息、助手回复），只读写一次数据库
+        
+        Args:
+            user_id: 用户ID
+            media_info: 媒体信息
+            user_message: 用户消息内容
+            assistant_message: 助手回复内容
             
-            # 更新数据库
-            with db.get_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute(
-                    "UPDATE conversation SET messages = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
-                    (json.dumps(messages), session['id'])
-                )
-                conn.commit()
+        Returns:
+            是否成功
+        """
+        new_messages = []
+        if user_message is not None:
+            new_messages.append(("user", user_message))
+        if assistant_message is not None:
+            new_messages.append(("assistant", assistant_message))
+        
+        new_media = []
+        if media_info is not None:
+            media_info['added_at'] = now_iso()
+            new_media.append(media_info)
+        
+        try:
+            self._modify_session(user_id, new_messages, new_media)
             
-            logger.info(f"添加消息: user_id={user_id}, role={role}")
+            logger.info(f"写入对话轮次: user_id={user_id}")
             return True
             
         except Exception as e:
-            logger.error(f"添加消息失败: {e}")
+            logger.error(f"写入对话轮次失败: {e}")
             return False
     
     def add_media_to_context(self, user_id: str, media_info: Dict[str, Any]) -> bool:
@@ -208,21 +499,9 @@ class ConversationService:
             是否成功
         """
         try:
-            session = self.get_or_create_session(user_id)
-            media_files = session['media_files']
-            
             # 添加媒体信息
-            media_info['added_at'] = datetime.now().isoformat()
-            media_files.append(media_info)
-            
-            # 更新数据库
-            with db.get_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute(
-                    "UPDATE conversation SET media_files = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
-                    (json.dumps(media_files), session['id'])
-                )
-                conn.commit()
+            media_info['added_at'] = now_iso()
+            self._modify_session(user_id, new_media=[media_info])
             
             logger.info(f"添加媒体信息: user_id={user_id}, type={media_info.get('type')}")
             return True
@@ -241,8 +520,14 @@ class ConversationService:
         Returns:
             媒体文件列表
         """
-        session = self.get_or_create_session(user_id)
-        return session.get('media_files', [])
+        # 只取媒体文件，不构建消息上下文
+        try:
+            session = self._load_session(user_id)
+            with self._session_lock:
+                return list(session['media_files'])
+        except Exception as e:
+            logger.error(f"获取媒体文件失败: {e}")
+            return []
     
     def clear_media_files(self, user_id: str) -> bool:
         """
@@ -255,16 +540,7 @@ class ConversationService:
             是否成功
         """
         try:
-            session = self.get_or_create_session(user_id)
-            
-            # 更新数据库
-            with db.get_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute(
-                    "UPDATE conversation SET media_files = '[]', updated_at = CURRENT_TIMESTAMP WHERE id = ?",
-                    (session['id'],)
-                )
-                conn.commit()
+            self._modify_session(user_id, clear_media=True)
             
             logger.info(f"清空媒体文件: user_id={user_id}")
             return True
@@ -283,18 +559,25 @@ class ConversationService:
         Returns:
             消息列表
         """
-        session = self.get_or_create_session(user_id)
-        messages = session['messages']
-        
-        # 转换为LLM需要的格式（去掉timestamp）
-        context = []
-        for msg in messages:
-            context.append({
-                "role": msg['role'],
-                "content": msg['content']
-            })
+        return self.get_context_and_media(user_id)[0]
+    
+    def get_context_and_media(self, user_id: str) -> Tuple[List[Dict[str, str]], List[Dict[str, Any]]]:
+        """
+        一次读取对话上下文和媒体文件（生成日记时使用，避免多次查询会话）
         
-        return context
+        Args:
+            user_id: 用户ID
+            
+        Returns:
+            (消息列表, 媒体文件列表)
+        """
+        try:
+            session = self._load_session(user_id)
+            with self._session_lock:
+                return session['system_ctx'] + list(session['tail_ctx']), list(session['media_files'])
+        except Exception as e:
+            logger.error(f"获取对话上下文失败: {e}")
+            return [{"role": "system", "content": SYSTEM_PROMPT}], []
     
     def close_session(self, user_id: str) -> bool:
         """
@@ -307,11 +590,13 @@ class ConversationService:
             是否成功
         """
         try:
-            today = datetime.now().strftime("%Y-%m-%d")
+            today = today_str()
             db.execute(
                 "UPDATE conversation SET status = 'closed' WHERE user_id = ? AND session_date = ? AND status = 'active'",
                 (user_id, today)
             )
+            with self._session_lock:
+                self._session_cache.pop(user_id, None)
             logger.info(f"关闭会话: user_id={user_id}")
             return True
         except Exception as e:
@@ -328,17 +613,19 @@ class ConversationService:
         Returns:
             日记内容文本
         """
-        context = self.get_context(user_id)
-        
-        # 提取用户和助手的对话
-        diary_lines = []
-        for msg in context:
-            if msg['role'] == 'user':
-                diary_lines.append(f"我: {msg['content']}")
-            elif msg['role'] == 'assistant':
-                diary_lines.append(f"助手: {msg['content']}")
+        try:
+            session = self._load_session(user_id)
+        except Exception as e:
+            logger.error(f"获取日记原始数据失败: {e}")
+            return ""
         
-        return "\n".join(diary_lines)
+        # 提取用户和助手的对话（直接遍历缓存中的非系统消息，不构建中间列表）
+        speakers = {"user": "我: ", "assistant": "助手: "}
+        with self._session_lock:
+            return "\n".join(
+                speakers[msg['role']] + msg['content']
+                for msg in session['tail_ctx'] if msg['role'] in speakers
+            )
 
 
 # 创建全局对话服务实例
@@ -3,11 +3,25 @@
 管理日记的保存、查询、更新等操作
 """
 
-import json
-from datetime import datetime
-from typing import List, Dict, Any, Optional
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional, Tuple
 from src.utils.database import db
 from src.utils.logger import logger
+from src.utils.timeutil import today_str
+
+# 按ID缓存的日记条数（LRU淘汰）
+DIARY_CACHE_SIZE = 256
+# 今日日记缓存的有效期（秒）
+TODAY_DIARY_CACHE_TTL = 60
+
+# 日记的列表字段 -> (子表名, 值列名)；每个元素一行，不再整体存为JSON
+LIST_TABLES = {
+    "tags": ("diary_tags", "tag"),
+    "images": ("diary_images", "url"),
+}
 
 
 class DiaryService:
@@ -15,6 +29,10 @@ class DiaryService:
     
     def __init__(self):
         """初始化日记服务"""
+        # diary_id -> 日记；(user_id, 日期) -> (过期时间, 日记或None)；写入/删除时失效
+        self._diary_cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._today_cache: Dict[Tuple[str, str], Tuple[float, Optional[Dict[str, Any]]]] = {}
+        self._cache_lock = threading.Lock()
         self._init_table()
     
     def _init_table(self):
@@ -22,6 +40,11 @@ class DiaryService:
         try:
             with db.get_connection() as conn:
                 cursor = conn.cursor()
+                # 整个建表/迁移过程放在一个事务里，只提交一次
+                cursor.execute("BEGIN")
+                cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
+                existing_tables = {row[0] for row in cursor.fetchall()}
+                
                 cursor.execute("""
                     CREATE TABLE IF NOT EXISTS diaries (
                         id TEXT PRIMARY KEY,
@@ -40,6 +63,32 @@ class DiaryService:
                         updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                     )
                 """)
+                
+                # 热点查询的索引：按用户列表、按用户+日期、按文档ID
+                cursor.execute("CREATE INDEX IF NOT EXISTS idx_diaries_user_created ON diaries(user_id, created_at DESC)")
+                cursor.execute("CREATE INDEX IF NOT EXISTS idx_diaries_user_date ON diaries(user_id, create_date, created_at)")
+                cursor.execute("CREATE INDEX IF NOT EXISTS idx_diaries_docid ON diaries(document_id)")
+                
+                # 标签/图片子表（diaries.tags / diaries.images 列仅为兼容旧数据保留）
+                for field, (table, column) in LIST_TABLES.items():
+                    if table in existing_tables:
+                        continue
+                    cursor.execute(f"""
+                        CREATE TABLE {table} (
+                            diary_id TEXT NOT NULL,
+                            seq INTEGER NOT NULL,
+                            {column} TEXT NOT NULL,
+                            PRIMARY KEY (diary_id, seq)
+                        )
+                    """)
+                    # 迁移旧的JSON数组数据
+                    cursor.execute(f"""
+                        INSERT INTO {table} (diary_id, seq, {column})
+                        SELECT d.id, CAST(j.key AS INTEGER), j.value
+                        FROM diaries d, json_each(d.{field}) j
+                        WHERE json_valid(d.{field})
+                    """)
+                
                 conn.commit()
                 logger.info("日记表初始化完成")
         except Exception as e:
@@ -69,20 +118,40 @@ class DiaryService:
             是否成功
         """
         try:
-            today = datetime.now().strftime("%Y-%m-%d")
+            today = today_str()
 
             with db.get_connection() as conn:
                 cursor = conn.cursor()
+                # UPSERT：已存在时原地更新，保留 created_at，避免 REPLACE 的先删后插
                 cursor.execute("""
-                    INSERT OR REPLACE INTO diaries
-                    (id, user_id, title, content, summary, mood, weather, location, tags, images, document_id, create_date, updated_at)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+                    INSERT INTO diaries
+                    (id, user_id, title, content, summary, mood, weather, location, document_id, create_date, updated_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+                    ON CONFLICT(id) DO UPDATE SET
+                        user_id = excluded.user_id,
+                        title = excluded.title,
+                        content = excluded.content,
+                        summary = excluded.summary,
+                        mood = excluded.mood,
+                        weather = excluded.weather,
+                        location = excluded.location,
+                        document_id = excluded.document_id,
+                        create_date = excluded.create_date,
+                        updated_at = CURRENT_TIMESTAMP
                 """, (
-                    diary_id, user_id, title, content, summary, mood, weather, location,
-                    json.dumps(tags or []), json.dumps(images or []), document_id, today
+                    diary_id, user_id, title, content, summary, mood, weather, location, document_id, today
                 ))
+                
+                # 重写标签/图片子表
+                for values, (table, column) in zip((tags, images), LIST_TABLES.values()):
+                    cursor.execute(f"DELETE FROM {table} WHERE diary_id = ?", (diary_id,))
+                    cursor.executemany(
+                        f"INSERT INTO {table} (diary_id, seq, {column}) VALUES (?, ?, ?)",
+                        [(diary_id, seq, value) for seq, value in enumerate(values or [])]
+                    )
                 conn.commit()
 
+                self._invalidate(diary_id, user_id)
                 logger.info(f"日记保存成功: {diary_id}")
                 return True
 
@@ -90,6 +159,36 @@ class DiaryService:
             logger.error(f"保存日记失败: {e}")
             return False
     
+    def update_document_id(self, diary_id: str, document_id: str) -> bool:
+        """
+        更新日记关联的飞书文档ID
+
+        Args:
+            diary_id: 日记ID
+            document_id: 飞书文档ID
+
+        Returns:
+            是否成功
+        """
+        try:
+            db.execute(
+                "UPDATE diaries SET document_id = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+                (document_id, diary_id)
+            )
+            self._invalidate(diary_id)
+            logger.info(f"日记文档ID已更新: {diary_id} -> {document_id}")
+            return True
+
+        except Exception as e:
+            logger.error(f"更新日记文档ID失败: {e}")
+            return False
+    
+    def _copy_diary(self, diary: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        """复制缓存中的日记（含标签/图片列表），调用方修改返回值不会影响缓存"""
+        if diary is None:
+            return None
+        return {**diary, "tags": list(diary["tags"]), "images": list(diary["images"])}
+    
     def get_diary_by_id(self, diary_id: str) -> Optional[Dict[str, Any]]:
         """
         根据ID获取日记
@@ -100,14 +199,25 @@ class DiaryService:
         Returns:
             日记信息
         """
+        with self._cache_lock:
+            diary = self._diary_cache.get(diary_id)
+            if diary is not None:
+                self._diary_cache.move_to_end(diary_id)
+                return self._copy_diary(diary)
+        
         try:
-            result = db.fetch_one(
+            results = self._fetch_diaries(
                 "SELECT * FROM diaries WHERE id = ?",
                 (diary_id,)
             )
             
-            if result:
-                return self._format_diary(result)
+            if results:
+                diary = results[0]
+                with self._cache_lock:
+                    self._diary_cache[diary_id] = diary
+                    if len(self._diary_cache) > DIARY_CACHE_SIZE:
+                        self._diary_cache.popitem(last=False)
+                return self._copy_diary(diary)
             return None
             
         except Exception as e:
@@ -127,13 +237,11 @@ class DiaryService:
             日记列表
         """
         try:
-            results = db.fetch_all(
+            return self._fetch_diaries(
                 "SELECT * FROM diaries WHERE user_id = ? ORDER BY created_at DESC LIMIT ? OFFSET ?",
                 (user_id, limit, offset)
             )
             
-            return [self._format_diary(r) for r in results]
-            
         except Exception as e:
             logger.error(f"获取日记列表失败: {e}")
             return []
@@ -150,13 +258,11 @@ class DiaryService:
             日记列表
         """
         try:
-            results = db.fetch_all(
+            return self._fetch_diaries(
                 "SELECT * FROM diaries WHERE user_id = ? AND create_date = ? ORDER BY created_at DESC",
                 (user_id, date)
             )
             
-            return [self._format_diary(r) for r in results]
-            
         except Exception as e:
             logger.error(f"获取日期日记失败: {e}")
             return []
@@ -171,9 +277,42 @@ class DiaryService:
         Returns:
             日记信息
         """
-        today = datetime.now().strftime("%Y-%m-%d")
-        diaries = self.get_diaries_by_date(user_id, today)
-        return diaries[0] if diaries else None
+        key = (user_id, today_str())
+        now = time.time()
+        with self._cache_lock:
+            cached = self._today_cache.get(key)
+            if cached is not None and cached[0] > now:
+                return self._copy_diary(cached[1])
+        
+        diaries = self.get_diaries_by_date(user_id, key[1])
+        diary = diaries[0] if diaries else None
+        with self._cache_lock:
+            # 顺带清理过期条目，避免跨天后旧键累积
+            self._today_cache = {k: v for k, v in self._today_cache.items() if v[0] > now}
+            self._today_cache[key] = (now + TODAY_DIARY_CACHE_TTL, diary)
+        return self._copy_diary(diary)
+    
+    def _invalidate(self, diary_id: Optional[str] = None, user_id: Optional[str] = None) -> None:
+        """
+        使日记缓存失效；不指定任何参数时清空全部缓存（批量删除时使用）
+        
+        Args:
+            diary_id: 日记ID
+            user_id: 用户ID（清除该用户的今日日记缓存）
+        """
+        with self._cache_lock:
+            if diary_id is None and user_id is None:
+                self._diary_cache.clear()
+                self._today_cache.clear()
+                return
+            
+            if diary_id is not None:
+                self._diary_cache.pop(diary_id, None)
+            # 未指定用户时，清除引用了该日记的今日缓存
+            self._today_cache = {
+                k: v for k, v in self._today_cache.items()
+                if k[0] != user_id and not (user_id is None and v[1] and v[1]["id"] == diary_id)
+            }
 
     def get_diaries_by_document_id(self, document_id: str) -> List[Dict[str, Any]]:
         """
@@ -186,57 +325,60 @@ class DiaryService:
             日记列表
         """
         try:
-            with db.get_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute(
-                    "SELECT * FROM diaries WHERE document_id = ?",
-                    (document_id,)
-                )
-                results = cursor.fetchall()
-
-                # 获取列名
-                columns = [description[0] for description in cursor.description]
-
-                # 转换为字典列表
-                diaries = []
-                for row in results:
-                    diary = dict(zip(columns, row))
-                    diaries.append(self._format_diary(diary))
-
-                return diaries
+            return self._fetch_diaries(
+                "SELECT * FROM diaries WHERE document_id = ?",
+                (document_id,)
+            )
 
         except Exception as e:
             logger.error(f"根据文档ID获取日记失败: {e}")
             return []
 
-    def delete_diary(self, diary_id: str) -> bool:
+    def _fetch_diaries(self, query: str, params: tuple = ()) -> List[Dict[str, Any]]:
         """
-        删除日记
-        
+        查询日记并批量加载标签/图片（每个子表一条 IN 查询，避免逐行查询）
+
         Args:
-            diary_id: 日记ID
-            
+            query: 查询 diaries 表的SQL语句
+            params: 查询参数
+
         Returns:
-            是否成功
+            格式化后的日记列表
         """
-        try:
-            db.execute(
-                "DELETE FROM diaries WHERE id = ?",
-                (diary_id,)
-            )
-            logger.info(f"日记删除成功: {diary_id}")
-            return True
-            
-        except Exception as e:
-            logger.error(f"删除日记失败: {e}")
-            return False
-    
-    def _format_diary(self, row: Dict[str, Any]) -> Dict[str, Any]:
+        with db.get_connection() as conn:
+            cursor = conn.cursor()
+            # 日记行按列名格式化，需要 Row 对象
+            cursor.row_factory = sqlite3.Row
+            rows = cursor.execute(query, params).fetchall()
+            if not rows:
+                return []
+
+            ids = [row["id"] for row in rows]
+            placeholders = ",".join("?" * len(ids))
+            lists = {}
+            for field, (table, column) in LIST_TABLES.items():
+                values = {}
+                cursor.execute(
+                    f"SELECT diary_id, {column} FROM {table} WHERE diary_id IN ({placeholders}) ORDER BY diary_id, seq",
+                    ids
+                )
+                for diary_id, value in cursor.fetchall():
+                    values.setdefault(diary_id, []).append(value)
+                lists[field] = values
+
+        return [
+            self._format_diary(row, lists["tags"].get(row["id"], []), lists["images"].get(row["id"], []))
+            for row in rows
+        ]
+
+    def _format_diary(self, row: Dict[str, Any], tags: List[str], images: List[str]) -> Dict[str, Any]:
         """
         格式化日记数据
 
         Args:
-            row: 数据库行
+            row: 数据库行（字典或 sqlite3.Row）
+            tags: 标签列表
+            images: 图片URL列表
 
         Returns:
             格式化后的日记
@@ -250,9 +392,9 @@ class DiaryService:
             "mood": row["mood"],
             "weather": row["weather"],
             "location": row["location"],
-            "tags": json.loads(row["tags"]) if row["tags"] else [],
-            "images": json.loads(row["images"]) if row["images"] else [],
-            "document_id": row.get("document_id", ""),
+            "tags": tags,
+            "images": images,
+            "document_id": row["document_id"],
             "create_date": row["create_date"],
             "created_at": row["created_at"],
             "updated_at": row["updated_at"]
@@ -271,8 +413,11 @@ class DiaryService:
         try:
             with db.get_connection() as conn:
                 cursor = conn.cursor()
+                for table, _ in LIST_TABLES.values():
+                    cursor.execute(f"DELETE FROM {table} WHERE diary_id = ?", (diary_id,))
                 cursor.execute("DELETE FROM diaries WHERE id = ?", (diary_id,))
                 conn.commit()
+                self._invalidate(diary_id)
 
                 if cursor.rowcount > 0:
                     logger.info(f"日记删除成功: {diary_id}")
@@ -298,8 +443,14 @@ class DiaryService:
         try:
             with db.get_connection() as conn:
                 cursor = conn.cursor()
+                for table, _ in LIST_TABLES.values():
+                    cursor.execute(
+                        f"DELETE FROM {table} WHERE diary_id IN (SELECT id FROM diaries WHERE user_id = ?)",
+                        (user_id,)
+                    )
                 cursor.execute("DELETE FROM diaries WHERE user_id = ?", (user_id,))
                 conn.commit()
+                self._invalidate()
 
                 deleted_count = cursor.rowcount
                 logger.info(f"用户 {user_id} 的日记已清空，共删除 {deleted_count} 条")
@@ -309,6 +460,35 @@ class DiaryService:
             logger.error(f"清空用户日记失败: {e}")
             return 0
 
+    def delete_by_document_id(self, document_id: str) -> int:
+        """
+        删除关联指定飞书文档的所有日记
+
+        Args:
+            document_id: 飞书文档ID
+
+        Returns:
+            删除的日记数量
+        """
+        try:
+            with db.get_connection() as conn:
+                cursor = conn.cursor()
+                for table, _ in LIST_TABLES.values():
+                    cursor.execute(
+                        f"DELETE FROM {table} WHERE diary_id IN (SELECT id FROM diaries WHERE document_id = ?)",
+                        (document_id,)
+                    )
+                cursor.execute("DELETE FROM diaries WHERE document_id = ?", (document_id,))
+                conn.commit()
+                deleted_count = cursor.rowcount
+            self._invalidate()
+            logger.info(f"文档 {document_id} 关联的日记已删除，共 {deleted_count} 条")
+            return deleted_count
+
+        except Exception as e:
+            logger.error(f"按文档ID删除日记失败: {e}")
+            return 0
+
 
 # 创建全局日记服务实例
 diary_service = DiaryService()
@@ -4,13 +4,53 @@
 支持图片插入功能
 """
 
-import json
-from typing import Dict, Any, Optional, List
-from datetime import datetime
+import logging
+import random
+import asyncio
+import tempfile
+import orjson
+from typing import Dict, Any, Optional, List, Tuple, IO
 import httpx
-from urllib.parse import quote
 from src.utils.config import settings
 from src.utils.logger import logger
+from src.utils.token_cache import TokenCache, INVALID_TOKEN_CODES
+
+# 飞书文档访问链接前缀
+DOC_URL_PREFIX = "https://www.feishu.cn/docx/"
+
+# 飞书开放平台API地址
+FEISHU_API_BASE = "https://open.feishu.cn"
+
+# tenant_access_token 提前刷新的秒数
+TOKEN_REFRESH_MARGIN = 60
+
+# 遇到限流或服务端错误时的重试次数和最大退避时间（秒）
+FEISHU_MAX_RETRIES = 3
+FEISHU_RETRY_MAX_DELAY = 10.0
+_RETRY_STATUS = frozenset({429, 500, 502, 503, 504})
+_IDEMPOTENT_METHODS = frozenset({"GET", "DELETE", "PATCH", "PUT"})
+
+# 飞书开放平台接口：名称 -> (HTTP方法, 路径模板, 日志描述, 5xx时是否可重试)
+_ENDPOINTS = {
+    "tenant_access_token": ("POST", "/open-apis/auth/v3/tenant_access_token/internal", "获取tenant_token", True),
+    "create_document": ("POST", "/open-apis/docx/v1/documents", "创建文档", False),
+    "create_children": ("POST", "/open-apis/docx/v1/documents/{document_id}/blocks/{document_id}/children", "创建文档块", False),
+    "batch_update": ("PATCH", "/open-apis/docx/v1/documents/{document_id}/blocks/batch_update", "更新图片块", True),
+    "add_permission": ("POST", "/open-apis/drive/v1/permissions/{document_id}/members?type=docx&need_notification=false", "设置文档权限", True),
+    "delete_file": ("DELETE", "/open-apis/drive/v1/files/{document_id}?type=docx", "删除文档", True),
+    # 重复上传只会多产生一个未引用的 file_token，可以安全重试
+    "upload_media": ("POST", "/open-apis/drive/v1/medias/upload_all", "上传图片", True),
+}
+
+# 图片下载缓冲：不超过该大小时保存在内存，超过则写入临时文件
+IMAGE_SPOOL_SIZE = 4 * 1024 * 1024
+
+# Markdown 标题前缀 -> (飞书块类型, 块字段名)
+_HEADING_SPECS = (
+    ("# ", 3, "heading1"),
+    ("## ", 4, "heading2"),
+    ("### ", 5, "heading3"),
+)
 
 
 class FeishuDocService:
@@ -20,154 +60,284 @@ class FeishuDocService:
         """初始化文档服务"""
         self.app_id = settings.feishu_app_id
         self.app_secret = settings.feishu_app_secret
+        self._limits = httpx.Limits(
+            max_connections=settings.feishu_http_max_connections,
+            max_keepalive_connections=settings.feishu_http_max_keepalive,
+            keepalive_expiry=settings.feishu_http_keepalive_expiry
+        )
+        # 长连接复用的HTTP客户端，首次使用时创建
+        self._client: Optional[httpx.AsyncClient] = None
+        # tenant_access_token 缓存（媒体处理服务也复用该缓存）
+        self.token_cache = TokenCache(self._fetch_tenant_access_token, TOKEN_REFRESH_MARGIN)
     
-    async def _get_tenant_access_token(self) -> str:
-        """获取租户访问令牌"""
+    async def _client_get(self) -> httpx.AsyncClient:
+        """获取共享的HTTP客户端（连接池 + keep-alive，避免每次请求重新握手）"""
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=FEISHU_API_BASE,
+                http2=True,
+                timeout=30.0,
+                limits=self._limits
+            )
+        return self._client
+    
+    async def _request(self, method: str, url: str, *, retries: int = FEISHU_MAX_RETRIES,
+                       idempotent: Optional[bool] = None, stream: bool = False, **kwargs) -> httpx.Response:
+        """
+        发送飞书API请求，遇到429和5xx时指数退避（带随机抖动）重试
+        非幂等请求只在429（请求未被处理）时重试，避免重复创建文档或块
+        
+        Args:
+            method: HTTP方法
+            url: 相对于 FEISHU_API_BASE 的路径
+            retries: 最大重试次数
+            idempotent: 5xx时是否可以重试，默认按HTTP方法判断
+            stream: 是否以流式方式返回响应（由调用方关闭）
+            **kwargs: 透传给 httpx 的请求参数
+            
+        Returns:
+            最后一次请求的响应
+        """
+        if idempotent is None:
+            idempotent = method in _IDEMPOTENT_METHODS
+        
+        client = await self._client_get()
+        for attempt in range(retries + 1):
+            response = await client.send(client.build_request(method, url, **kwargs), stream=stream)
+            status = response.status_code
+            if attempt == retries or status not in _RETRY_STATUS or (status != 429 and not idempotent):
+                return response
+            
+            if stream:
+                await response.aclose()
+            
+            # 限流时优先使用服务端给出的 Retry-After
+            retry_after = response.headers.get("Retry-After", "")
+            if status == 429 and retry_after.isdigit():
+                delay = min(float(retry_after), FEISHU_RETRY_MAX_DELAY)
+            else:
+                delay = min(2 ** attempt + random.random(), FEISHU_RETRY_MAX_DELAY)
+            logger.warning("飞书API %s %s 返回 %s，%.1f秒后重试 (%d/%d)", method, url, status, delay, attempt + 1, retries)
+            await asyncio.sleep(delay)
+    
+    async def _call(self, endpoint: str, token: Optional[str] = None, payload: Optional[Dict[str, Any]] = None,
+                    path_args: Optional[Dict[str, str]] = None, retry_auth: bool = True,
+                    **kwargs) -> Optional[Dict[str, Any]]:
+        """
+        调用 _ENDPOINTS 中登记的飞书接口
+        统一处理鉴权头、JSON序列化、HTTP状态码和业务码检查以及日志；
+        token 被判定失效时丢弃缓存，换新 token 重试一次
+        
+        Args:
+            endpoint: 接口名称
+            token: tenant_access_token，为空时不带鉴权头
+            payload: JSON请求体
+            path_args: 路径模板参数
+            retry_auth: token 失效时是否刷新后重试
+            **kwargs: 透传给 _request 的参数（files、timeout 等）
+            
+        Returns:
+            接口返回的JSON（code == 0），失败返回None
+        """
+        method, path, label, idempotent = _ENDPOINTS[endpoint]
+        if path_args:
+            path = path.format(**path_args)
+        
+        headers = {"Authorization": "Bearer " + token} if token else {}
+        if payload is not None:
+            headers["Content-Type"] = "application/json"
+            kwargs["content"] = orjson.dumps(payload)
+        
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    "https://open.feishu.cn/open-apis/auth/v3/tenant_access_token/internal",
-                    json={
-                        "app_id": self.app_id,
-                        "app_secret": self.app_secret
-                    }
-                )
-                
-                if response.status_code == 200:
-                    result = response.json()
-                    if result.get("code") == 0:
-                        return result["tenant_access_token"]
-                    else:
-                        logger.error("获取tenant_token失败: " + str(result))
-                        return ""
-                else:
-                    logger.error("获取tenant_token请求失败: " + str(response.status_code))
-                    return ""
+            response = await self._request(method, path, headers=headers, idempotent=idempotent, **kwargs)
+            
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("%sAPI响应: %s - %.500s", label, response.status_code, response.text)
+            
+            try:
+                result = orjson.loads(response.content)
+            except orjson.JSONDecodeError:
+                result = None
+            
+            # token 被重置或提前失效（飞书返回400及对应业务码）
+            if token and retry_auth and isinstance(result, dict) and result.get("code") in INVALID_TOKEN_CODES:
+                self.token_cache.invalidate(token)
+                new_token = await self.token_cache.get()
+                if new_token and new_token != token:
+                    logger.warning("%s: tenant_access_token已失效(%s)，刷新后重试", label, result.get("code"))
+                    return await self._call(endpoint, new_token, payload, path_args, retry_auth=False, **kwargs)
+            
+            if response.status_code != 200:
+                logger.error("%s请求失败: %s, 响应: %s", label, response.status_code, response.text)
+                return None
+            
+            if not isinstance(result, dict) or result.get("code") != 0:
+                logger.error("%sAPI错误: %s", label, result)
+                return None
+            return result
         except Exception as e:
-            logger.error("获取tenant_token异常: " + str(e))
-            return ""
+            logger.error("%s异常: %s", label, e)
+            return None
+    
+    async def set_http_limits(self, max_connections: int, max_keepalive_connections: int,
+                              keepalive_expiry: Optional[float] = None):
+        """
+        调整连接池大小，下一次请求时按新配置重建客户端
+        
+        Args:
+            max_connections: 最大连接数
+            max_keepalive_connections: 最大空闲保活连接数
+            keepalive_expiry: 空闲连接保活秒数，为空时保持不变
+        """
+        self._limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=self._limits.keepalive_expiry if keepalive_expiry is None else keepalive_expiry
+        )
+        await self.aclose()
+    
+    async def aclose(self):
+        """关闭共享的HTTP客户端（应用关闭时调用）"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+    
+    async def _get_tenant_access_token(self) -> str:
+        """获取租户访问令牌（缓存至过期前 TOKEN_REFRESH_MARGIN 秒）"""
+        return await self.token_cache.get()
+    
+    async def _fetch_tenant_access_token(self) -> Tuple[str, float]:
+        """请求新的租户访问令牌，返回 (token, 有效秒数)"""
+        result = await self._call("tenant_access_token", payload={
+            "app_id": self.app_id,
+            "app_secret": self.app_secret
+        })
+        if result is None:
+            return "", 0
+        return result["tenant_access_token"], result.get("expire", 0)
     
-    async def create_document(self, title: str, content: str, folder_token: Optional[str] = None) -> Optional[Dict[str, Any]]:
-        """创建飞书文档"""
+    async def create_document(self, title: str, content: str, folder_token: Optional[str] = None,
+                              token: Optional[str] = None, user_id: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """
+        创建飞书文档
+        
+        Args:
+            title: 文档标题
+            content: 文档内容
+            folder_token: 目标文件夹
+            token: 已获取的 tenant_access_token，为空时自动获取
+            user_id: 需要授予完全访问权限的用户，与添加内容并发设置
+            
+        Returns:
+            文档信息
+        """
         try:
-            token = await self._get_tenant_access_token()
+            token = token or await self._get_tenant_access_token()
             if not token:
                 logger.error("无法获取tenant_access_token")
                 return None
             
-            async with httpx.AsyncClient() as client:
-                # 创建文档
-                create_response = await client.post(
-                    "https://open.feishu.cn/open-apis/docx/v1/documents",
-                    headers={"Authorization": "Bearer " + token},
-                    json={
-                        "title": title,
-                        "folder_token": folder_token
-                    }
+            document_id = await self._create_empty_document(title, folder_token, token)
+            if not document_id:
+                return None
+            
+            # 添加文档内容（Feishu 创建接口不支持初始内容，权限设置与之并发）
+            if user_id:
+                content_added, _ = await asyncio.gather(
+                    self._add_document_content(document_id, content, token),
+                    self._set_document_permission(document_id, user_id, token)
                 )
-                
-                if create_response.status_code != 200:
-                    logger.error("创建文档失败: " + str(create_response.status_code))
-                    return None
-                
-                create_result = create_response.json()
-                if create_result.get("code") != 0:
-                    logger.error("创建文档API错误: " + str(create_result))
-                    return None
-                
-                document_info = create_result["data"]["document"]
-                document_id = document_info["document_id"]
-                
-                logger.info("文档创建成功: " + document_id)
-                
-                # 添加文档内容
+            else:
                 content_added = await self._add_document_content(document_id, content, token)
-                
-                if not content_added:
-                    logger.warning("文档内容添加失败，但文档已创建")
-                
-                return {
-                    "document_id": document_id,
-                    "title": title,
-                    "url": "https://www.feishu.cn/docx/" + document_id
-                }
-                
+            
+            if content_added is None:
+                logger.warning("文档内容添加失败，但文档已创建")
+            
+            return self._document_result(document_id, title)
+            
         except Exception as e:
             logger.error("创建文档异常: " + str(e))
             return None
     
-    async def _add_document_content(self, document_id: str, content: str, token: str) -> bool:
-        """添加文档内容"""
-        try:
-            blocks = self._convert_content_to_blocks(content)
+    def _document_result(self, document_id: str, title: str) -> Dict[str, Any]:
+        """构建返回给调用方的文档信息"""
+        return {
+            "document_id": document_id,
+            "title": title,
+            "url": DOC_URL_PREFIX + document_id
+        }
+    
+    async def _create_empty_document(self, title: str, folder_token: Optional[str], token: str) -> Optional[str]:
+        """
+        创建空白文档
+        
+        Returns:
+            文档ID，失败返回None
+        """
+        result = await self._call("create_document", token, {
+            "title": title,
+            "folder_token": folder_token
+        })
+        if result is None:
+            return None
+        
+        document_id = result["data"]["document"]["document_id"]
+        logger.info("文档创建成功: " + document_id)
+        return document_id
+    
+    async def _add_document_content(self, document_id: str, content: str, token: str,
+                                    image_count: int = 0) -> Optional[List[str]]:
+        """
+        添加文档内容
+        
+        Args:
+            document_id: 文档ID
+            content: 文本内容
+            token: tenant_access_token
+            image_count: 追加在正文后的空图片块数量
             
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    "https://open.feishu.cn/open-apis/docx/v1/documents/" + document_id + "/blocks/" + document_id + "/children",
-                    headers={"Authorization": "Bearer " + token},
-                    json={
-                        "children": blocks
-                    }
-                )
-                
-                logger.info("添加内容API响应: " + str(response.status_code) + " - " + response.text[:200])
-                
-                if response.status_code == 200:
-                    result = response.json()
-                    if result.get("code") == 0:
-                        logger.info("文档内容添加成功: " + document_id)
-                        return True
-                    else:
-                        logger.error("添加内容API错误: " + str(result))
-                        return False
-                else:
-                    logger.error("添加内容请求失败: " + str(response.status_code))
-                    return False
-                    
-        except Exception as e:
-            logger.error("添加文档内容异常: " + str(e))
-            return False
+        Returns:
+            追加的图片块ID列表，失败返回None
+        """
+        blocks = self._convert_content_to_blocks(content)
+        blocks.extend({"block_type": 27, "image": {}} for _ in range(image_count))
+        if not blocks:
+            return []
+        
+        result = await self._call("create_children", token, {"children": blocks},
+                                  path_args={"document_id": document_id})
+        if result is None:
+            return None
+        
+        logger.info("文档内容添加成功: " + document_id)
+        if not image_count:
+            return []
+        children = result["data"]["children"]
+        return [child["block_id"] for child in children[-image_count:]]
     
     def _convert_content_to_blocks(self, content: str) -> List[Dict[str, Any]]:
         """将文本内容转换为飞书文档块"""
         blocks = []
-        lines = content.split('\n')
+        append = blocks.append
         
-        for line in lines:
+        for line in content.split('\n'):
             line = line.strip()
             if not line:
                 continue
             
-            # 标题（以 # 开头）
-            if line.startswith('# '):
-                blocks.append({
-                    "block_type": 3,
-                    "heading1": {
-                        "elements": [{"text_run": {"content": line[2:]}}]
-                    }
-                })
-            elif line.startswith('## '):
-                blocks.append({
-                    "block_type": 4,
-                    "heading2": {
-                        "elements": [{"text_run": {"content": line[3:]}}]
-                    }
-                })
-            elif line.startswith('### '):
-                blocks.append({
-                    "block_type": 5,
-                    "heading3": {
-                        "elements": [{"text_run": {"content": line[4:]}}]
-                    }
-                })
-            # 普通文本
-            else:
-                blocks.append({
-                    "block_type": 2,
-                    "text": {
-                        "elements": [{"text_run": {"content": line}}]
-                    }
-                })
+            # 标题（以 # 开头），否则为普通文本
+            block_type, field, body = 2, "text", line
+            for prefix, heading_type, heading_field in _HEADING_SPECS:
+                if line.startswith(prefix):
+                    block_type, field, body = heading_type, heading_field, line[len(prefix):]
+                    break
+            
+            append({
+                "block_type": block_type,
+                field: {
+                    "elements": [{"text_run": {"content": body}}]
+                }
+            })
         
         return blocks
     
@@ -175,67 +345,66 @@ class FeishuDocService:
                                                content: str, images: List[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
         """创建或更新日记文档"""
         try:
-            # 创建文档
-            result = await self.create_document(title, content)
+            images = self._valid_images(images or [])
 
-            if not result:
-                logger.error("文档创建失败")
+            token = await self._get_tenant_access_token()
+            if not token:
+                logger.error("无法获取tenant_access_token")
                 return None
 
-            document_id = result['document_id']
-
-            # 设置文档权限，让用户可以编辑和删除
-            token = await self._get_tenant_access_token()
-            if token:
-                await self._set_document_permission(document_id, user_id, token)
+            # 创建文档
+            document_id = await self._create_empty_document(title, None, token)
+            if not document_id:
+                logger.error("文档创建失败")
+                return None
 
-                # 如果有图片，插入图片
-                if images and len(images) > 0:
-                    await self._insert_images_to_document(document_id, images, token)
+            # 设置文档权限（让用户可以编辑和删除）与写入正文、插入图片互不依赖，并发执行
+            results = await asyncio.gather(
+                self._fill_diary_document(document_id, content, images, token),
+                self._set_document_permission(document_id, user_id, token),
+                return_exceptions=True
+            )
+            for r in results:
+                if isinstance(r, Exception):
+                    logger.error("创建日记文档异常: " + str(r))
 
             logger.info("日记文档创建成功: " + document_id)
-            return result
+            return self._document_result(document_id, title)
 
         except Exception as e:
             logger.error("创建日记文档异常: " + str(e))
             return None
 
+    async def _fill_diary_document(self, document_id: str, content: str,
+                                   images: List[Dict[str, Any]], token: str) -> bool:
+        """
+        写入日记正文，并在正文后插入图片
+        图片占位块随正文一起创建，正文添加失败时单独创建图片块
+        """
+        image_block_ids = await self._add_document_content(document_id, content, token, len(images))
+        if image_block_ids is None:
+            logger.warning("文档内容添加失败，但文档已创建")
+
+        if images:
+            return await self._insert_images_to_document(document_id, images, token,
+                                                         image_block_ids or None)
+        return image_block_ids is not None
+
     async def _set_document_permission(self, document_id: str, user_id: str, token: str) -> bool:
         """
         设置文档权限，让用户可以编辑和删除
         使用飞书权限API: POST /open-apis/drive/v1/permissions/{token}/members
         """
-        try:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    f"https://open.feishu.cn/open-apis/drive/v1/permissions/{document_id}/members?type=docx&need_notification=false",
-                    headers={
-                        "Authorization": f"Bearer {token}",
-                        "Content-Type": "application/json"
-                    },
-                    json={
-                        "member_type": "openid",
-                        "member_id": user_id,
-                        "perm": "full_access"  # 给用户完全访问权限（可编辑、可删除）
-                    }
-                )
-
-                logger.info(f"设置文档权限响应: {response.status_code} - {response.text[:200]}")
-
-                if response.status_code == 200:
-                    result = response.json()
-                    if result.get("code") == 0:
-                        logger.info(f"文档权限设置成功: {document_id} for user {user_id}")
-                        return True
-                    else:
-                        logger.error(f"设置文档权限API错误: {result}")
-                        return False
-                else:
-                    logger.error(f"设置文档权限请求失败: {response.status_code}")
-                    return False
-        except Exception as e:
-            logger.error(f"设置文档权限异常: {e}")
+        result = await self._call("add_permission", token, {
+            "member_type": "openid",
+            "member_id": user_id,
+            "perm": "full_access"  # 给用户完全访问权限（可编辑、可删除）
+        }, path_args={"document_id": document_id})
+        if result is None:
             return False
+        
+        logger.info(f"文档权限设置成功: {document_id} for user {user_id}")
+        return True
     
     async def delete_document(self, document_id: str) -> bool:
         """
@@ -249,228 +418,236 @@ class FeishuDocService:
         Returns:
             是否删除成功
         """
-        try:
-            token = await self._get_tenant_access_token()
-            if not token:
-                logger.error("无法获取tenant_access_token")
-                return False
-
-            async with httpx.AsyncClient() as client:
-                # 添加 type=docx 参数
-                response = await client.delete(
-                    f"https://open.feishu.cn/open-apis/drive/v1/files/{document_id}?type=docx",
-                    headers={"Authorization": f"Bearer {token}"}
-                )
-
-                logger.info(f"删除文档API响应: {response.status_code} - {response.text[:500]}")
-
-                if response.status_code == 200:
-                    result = response.json()
-                    if result.get("code") == 0:
-                        logger.info(f"文档删除成功: {document_id}")
-                        return True
-                    else:
-                        logger.error(f"删除文档API错误: {result}")
-                        return False
-                else:
-                    logger.error(f"删除文档请求失败: {response.status_code}, 响应: {response.text}")
-                    return False
+        token = await self._get_tenant_access_token()
+        if not token:
+            logger.error("无法获取tenant_access_token")
+            return False
 
-        except Exception as e:
-            logger.error(f"删除文档异常: {e}")
+        result = await self._call("delete_file", token, path_args={"document_id": document_id})
+        if result is None:
             return False
+
+        logger.info(f"文档删除成功: {document_id}")
+        return True
     
-    async def _insert_images_to_document(self, document_id: str, images: List[Dict[str, Any]], token: str) -> bool:
+    def _valid_images(self, images: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """过滤缺少 image_key 或 message_id 的图片"""
+        valid = []
+        append = valid.append
+        for img in images:
+            if img.get('image_key') and img.get('message_id'):
+                append(img)
+            else:
+                logger.warning(f"图片 {img.get('file_name', 'image.jpg')} 缺少 image_key 或 message_id，跳过")
+        return valid
+    
+    async def _insert_images_to_document(self, document_id: str, images: List[Dict[str, Any]], token: str,
+                                         block_ids: Optional[List[str]] = None) -> bool:
         """
         插入图片到文档
-        正确流程：1. 创建图片块 -> 2. 直接上传图片到该图片块
+        正确流程：1. 批量创建图片块 -> 2. 并发下载并上传图片 -> 3. 一次 batch_update 绑定所有图片
+        
+        Args:
+            document_id: 文档ID
+            images: 图片信息列表（file_name, image_key, message_id）
+            token: tenant_access_token
+            block_ids: 已创建的空图片块ID（与 images 一一对应），为空时在此创建
         """
         try:
-            async with httpx.AsyncClient() as client:
-                for img in images:
-                    file_name = img.get('file_name', 'image.jpg')
-                    image_key = img.get('image_key')
-                    message_id = img.get('message_id')
-                    
-                    if not image_key or not message_id:
-                        logger.warning(f"图片 {file_name} 缺少 image_key 或 message_id，跳过")
-                        continue
-                    
-                    # 步骤1：创建图片块
-                    logger.info(f"创建图片块: {file_name}")
-                    block_response = await client.post(
-                        f"https://open.feishu.cn/open-apis/docx/v1/documents/{document_id}/blocks/{document_id}/children",
-                        headers={"Authorization": "Bearer " + token},
-                        json={
-                            "children": [{
-                                "block_type": 27,  # image block
-                                "image": {}  # 空的image属性
-                            }]
-                        }
-                    )
-                    
-                    logger.info(f"创建图片块响应: {block_response.status_code} - {block_response.text[:300]}")
-                    
-                    if block_response.status_code != 200:
-                        logger.error(f"创建图片块失败: {block_response.status_code}, 响应: {block_response.text}")
-                        continue
-                    
-                    block_result = block_response.json()
-                    if block_result.get("code") != 0:
-                        logger.error(f"创建图片块API错误: {block_result}")
-                        continue
-                    
-                    block_id = block_result["data"]["children"][0]["block_id"]
-                    logger.info(f"图片块创建成功: {block_id}")
-                    
-                    # 步骤2：下载图片（使用 message_id 和 image_key 作为 file_key）
-                    logger.info(f"下载图片: message_id={message_id}, file_key={image_key}")
-                    image_data = await self._download_image(message_id, image_key, token)
-                    if not image_data:
-                        logger.error(f"下载图片失败: {image_key}")
-                        continue
-                    
-                    # 步骤3：上传图片到文档
-                    logger.info(f"上传图片到文档: {document_id}")
-                    file_token = await self._upload_image_to_document(document_id, image_data, file_name, token)
-                    
-                    if not file_token:
-                        logger.error(f"图片上传失败: {file_name}")
-                        continue
-                    
-                    # 步骤4：更新图片块，绑定 file_token
-                    logger.info(f"更新图片块: {block_id} with file_token: {file_token}")
-                    update_success = await self._update_image_block(document_id, block_id, file_token, token)
-                    
-                    if update_success:
-                        logger.info(f"图片 {file_name} 插入成功")
-                    else:
-                        logger.error(f"图片 {file_name} 插入失败")
-                    
+            images = self._valid_images(images)
+            if not images:
+                return True
+            
+            # 步骤1：一次请求创建所有图片块
+            if not block_ids:
+                block_ids = await self._create_image_blocks(document_id, len(images), token)
+                if not block_ids:
+                    return False
+            
+            # 步骤2：并发下载并上传图片，HTTP/2下复用同一连接
+            results = await asyncio.gather(
+                *[self._transfer_image(document_id, img, token) for img in images],
+                return_exceptions=True
+            )
+            
+            pairs = []
+            append = pairs.append
+            log_err = logger.error
+            for img, block_id, file_token in zip(images, block_ids, results):
+                if isinstance(file_token, Exception):
+                    log_err(f"插入图片异常: {file_token}")
+                elif file_token:
+                    append((block_id, file_token))
+                else:
+                    log_err(f"图片 {img.get('file_name', 'image.jpg')} 插入失败")
+            
+            # 步骤3：一次 batch_update 绑定所有 file_token
+            if pairs:
+                logger.info(f"更新图片块: {len(pairs)} 个")
+                if await self._update_image_blocks(document_id, pairs, token):
+                    logger.info(f"图片插入成功: {len(pairs)}/{len(images)}")
+                
             return True
             
         except Exception as e:
             logger.error(f"插入图片异常: {e}")
             return False
     
-    async def _download_image(self, message_id: str, file_key: str, token: str) -> Optional[bytes]:
+    async def _create_image_blocks(self, document_id: str, count: int, token: str) -> Optional[List[str]]:
+        """
+        在文档末尾批量创建空图片块
+        
+        Returns:
+            图片块ID列表，失败返回None
+        """
+        logger.info(f"创建图片块: {count} 个")
+        result = await self._call("create_children", token, {
+            "children": [{
+                "block_type": 27,  # image block
+                "image": {}  # 空的image属性
+            } for _ in range(count)]
+        }, path_args={"document_id": document_id})
+        if result is None:
+            return None
+        
+        block_ids = [child["block_id"] for child in result["data"]["children"]]
+        logger.info(f"图片块创建成功: {block_ids}")
+        return block_ids
+    
+    async def _transfer_image(self, document_id: str, img: Dict[str, Any], token: str) -> Optional[str]:
+        """
+        下载消息中的图片并上传到文档
+        
+        Args:
+            document_id: 文档ID
+            img: 图片信息（file_name, image_key, message_id）
+            token: tenant_access_token
+            
+        Returns:
+            上传后的 file_token，失败返回None
+        """
+        file_name = img.get('file_name', 'image.jpg')
+        image_key = img.get('image_key')
+        message_id = img.get('message_id')
+        
+        # 下载图片（使用 message_id 和 image_key 作为 file_key）
+        logger.info(f"下载图片: message_id={message_id}, file_key={image_key}")
+        image_file = await self._download_image(message_id, image_key, token)
+        if image_file is None:
+            logger.error(f"下载图片失败: {image_key}")
+            return None
+        
+        # 上传图片到文档
+        logger.info(f"上传图片到文档: {document_id}")
+        with image_file:
+            file_token = await self._upload_image_to_document(document_id, image_file, file_name, token)
+        
+        if not file_token:
+            logger.error(f"图片上传失败: {file_name}")
+            return None
+        return file_token
+    
+    async def _download_image(self, message_id: str, file_key: str, token: str) -> Optional[IO[bytes]]:
         """
         下载图片
         使用飞书获取消息资源API: GET /open-apis/im/v1/messages/{message_id}/resources/{file_key}?type=image
         文档: https://open.feishu.cn/document/server-docs/im-v1/message/get
+        
+        Returns:
+            流式写入的图片缓冲文件（超过 IMAGE_SPOOL_SIZE 时落盘），由调用方关闭；失败返回None
         """
         try:
-            # 对 message_id 和 file_key 进行 URL 编码
-            encoded_message_id = quote(message_id, safe='')
-            encoded_file_key = quote(file_key, safe='')
-            
-            # 添加 type=image 查询参数
-            url = f"https://open.feishu.cn/open-apis/im/v1/messages/{encoded_message_id}/resources/{encoded_file_key}?type=image"
+            # 路径中的非法字符由 httpx 负责编码，type=image 作为查询参数传入
+            url = f"/open-apis/im/v1/messages/{message_id}/resources/{file_key}"
             logger.info(f"下载图片URL: {url}")
             
-            async with httpx.AsyncClient() as client:
-                response = await client.get(
-                    url,
-                    headers={"Authorization": f"Bearer {token}"},
-                    timeout=30.0
-                )
-                
+            response = await self._request(
+                "GET",
+                url,
+                params={"type": "image"},
+                headers={"Authorization": f"Bearer {token}"},
+                timeout=30.0,
+                stream=True
+            )
+            try:
                 logger.info(f"下载图片API响应: {response.status_code}")
                 
-                if response.status_code == 200:
-                    logger.info(f"图片下载成功: {len(response.content)} bytes")
-                    return response.content
-                else:
+                if response.status_code != 200:
+                    await response.aread()
                     logger.error(f"下载图片失败: {response.status_code}, {response.text[:500]}")
                     return None
+                
+                buf = tempfile.SpooledTemporaryFile(max_size=IMAGE_SPOOL_SIZE)
+                try:
+                    async for chunk in response.aiter_bytes(65536):
+                        buf.write(chunk)
+                except BaseException:
+                    buf.close()
+                    raise
+            finally:
+                await response.aclose()
+            
+            logger.info(f"图片下载成功: {buf.tell()} bytes")
+            return buf
         except Exception as e:
             logger.error(f"下载图片异常: {e}")
             return None
     
-    async def _upload_image_to_document(self, document_id: str, image_data: bytes, file_name: str, token: str) -> Optional[str]:
+    async def _upload_image_to_document(self, document_id: str, image_file: IO[bytes], file_name: str, token: str) -> Optional[str]:
         """
         上传图片到文档
         返回 file_token，用于后续绑定到图片块
         """
-        try:
-            async with httpx.AsyncClient() as client:
-                # 构建上传请求
-                # parent_type: doc_image
-                # parent_node: 文档ID (document_id)
-                files = {
-                    "file": (file_name, image_data, "image/jpeg"),
-                    "file_name": (None, file_name),
-                    "parent_type": (None, "doc_image"),
-                    "parent_node": (None, document_id),
-                    "size": (None, str(len(image_data)))
-                }
-                
-                response = await client.post(
-                    "https://open.feishu.cn/open-apis/drive/v1/medias/upload_all",
-                    headers={"Authorization": f"Bearer {token}"},
-                    files=files,
-                    timeout=60.0
-                )
-                
-                logger.info(f"上传图片响应: {response.status_code} - {response.text[:500]}")
-                
-                if response.status_code == 200:
-                    result = response.json()
-                    if result.get("code") == 0:
-                        file_token = result.get('data', {}).get('file_token')
-                        logger.info(f"图片上传成功: {file_token}")
-                        return file_token
-                    else:
-                        logger.error(f"上传图片API错误: {result}")
-                        return None
-                else:
-                    logger.error(f"上传图片请求失败: {response.status_code}")
-                    return None
-        except Exception as e:
-            logger.error(f"上传图片异常: {e}")
+        size = image_file.tell()
+        image_file.seek(0)
+        # 内存中的小图直接读出上传；已落盘的大图以文件流上传
+        # （httpx 会调用 fileno() 取长度，内存缓冲会因此被迫落盘）
+        image_data = image_file.read() if size <= IMAGE_SPOOL_SIZE else image_file
+        
+        # 构建上传请求
+        # parent_type: doc_image
+        # parent_node: 文档ID (document_id)
+        files = {
+            "file": (file_name, image_data, "image/jpeg"),
+            "file_name": (None, file_name),
+            "parent_type": (None, "doc_image"),
+            "parent_node": (None, document_id),
+            "size": (None, str(size))
+        }
+        
+        result = await self._call("upload_media", token, files=files, timeout=60.0)
+        if result is None:
             return None
+        
+        file_token = result.get('data', {}).get('file_token')
+        logger.info(f"图片上传成功: {file_token}")
+        return file_token
     
-    async def _update_image_block(self, document_id: str, block_id: str, file_token: str, token: str) -> bool:
+    async def _update_image_blocks(self, document_id: str, pairs: List[tuple], token: str) -> bool:
         """
-        更新图片块，绑定 file_token
-        使用 batch_update 接口的 replace_image 操作
+        批量更新图片块，绑定 file_token
+        使用 batch_update 接口的 replace_image 操作，所有图片合并为一次请求
+        
+        Args:
+            document_id: 文档ID
+            pairs: (block_id, file_token) 列表
+            token: tenant_access_token
         """
-        try:
-            async with httpx.AsyncClient() as client:
-                response = await client.patch(
-                    f"https://open.feishu.cn/open-apis/docx/v1/documents/{document_id}/blocks/batch_update",
-                    headers={
-                        "Authorization": f"Bearer {token}",
-                        "Content-Type": "application/json"
-                    },
-                    json={
-                        "requests": [
-                            {
-                                "block_id": block_id,
-                                "replace_image": {
-                                    "token": file_token
-                                }
-                            }
-                        ]
+        result = await self._call("batch_update", token, {
+            "requests": [
+                {
+                    "block_id": block_id,
+                    "replace_image": {
+                        "token": file_token
                     }
-                )
-                
-                logger.info(f"更新图片块响应: {response.status_code} - {response.text[:500]}")
-                
-                if response.status_code == 200:
-                    result = response.json()
-                    if result.get("code") == 0:
-                        logger.info(f"图片块更新成功: {block_id}")
-                        return True
-                    else:
-                        logger.error(f"更新图片块API错误: {result}")
-                        return False
-                else:
-                    logger.error(f"更新图片块请求失败: {response.status_code}")
-                    return False
-        except Exception as e:
-            logger.error(f"更新图片块异常: {e}")
+                } for block_id, file_token in pairs
+            ]
+        }, path_args={"document_id": document_id})
+        if result is None:
             return False
+        
+        logger.info(f"图片块更新成功: {[block_id for block_id, _ in pairs]}")
+        return True
 
 
 # 创建全局文档服务实例
@@ -4,13 +4,98 @@
 支持联网搜索获取实时信息
 """
 
-import json
+import re
+import time
+import random
+import asyncio
+import hashlib
+import orjson
+from collections import OrderedDict
 from typing import List, Dict, Any, Optional
-from datetime import datetime
+from datetime import datetime, timedelta
 import httpx
 from src.utils.config import settings
 from src.utils.logger import logger
 
+# 引导问题缓存：相同的近期对话直接复用回复，跳过LLM调用
+GUIDE_CACHE_TTL = 300
+GUIDE_CACHE_SIZE = 1000
+GUIDE_CACHE_TURNS = 6
+
+# 引导问题回复的最大token数
+GUIDE_MAX_TOKENS = 80
+
+# LLM并发上限，避免突发流量触发服务商限流
+_llm_semaphore = asyncio.Semaphore(settings.llm_max_async)
+
+# 遇到429限流时的重试次数和基础退避时间（秒）
+LLM_MAX_RETRIES = 3
+LLM_RETRY_BASE_DELAY = 1.0
+
+# 星期名称，按 datetime.weekday() 索引
+_WEEKDAYS = ('周一', '周二', '周三', '周四', '周五', '周六', '周日')
+
+# 需要联网搜索的关键词
+_SEARCH_KEYS_RE = re.compile("|".join(map(re.escape, [
+    '天气', '新闻', '今天', '现在', '最新', '股价', '汇率', '时间', '几号', '日期'
+])))
+
+# 可直接本地回答、无需调用LLM的简短日期/天气询问（整句匹配，避免误伤"今天天气很好"这类记录）
+_DIRECT_QUERY_RE = re.compile(
+    r"^(?:请问)?(?:今天|现在)?(?:是)?"
+    r"(?:几号|几月几[号日]|什么日子|什么日期|日期是?多少|星期几|周几|礼拜几"
+    r"|的?天气(?:怎么样|如何|好吗|咋样))"
+    r"[了呀啊呢吗？?。！!\s]*$"
+)
+DIRECT_QUERY_MAX_LEN = 30
+
+# 表示结束对话、生成日记的关键词
+_END_KEYS_RE = re.compile("|".join(map(re.escape, [
+    "结束", "完成", "整理", "生成日记", "好了", "就这样", "总结", "帮我总结", "整理日记"
+])))
+
+# 模拟回复的关键词类别，按优先级排列
+_MOCK_ORDER = ("weather", "time", "diary", "morning", "evening", "mood", "end")
+_MOCK_RANK = {key: rank for rank, key in enumerate(_MOCK_ORDER)}
+
+# 零宽前瞻匹配每个位置，关键词互相重叠（如"今天气温"）时也不会漏判
+_MOCK_RE = re.compile(
+    r"(?=(?:(?P<weather>天气)|(?P<time>时间|日期|今天几号)|(?P<diary>今天|日记)"
+    r"|(?P<morning>早上|上午)|(?P<evening>下午|晚上)|(?P<mood>心情|感觉)|(?P<end>结束|完成|整理)))"
+)
+
+_MOCK_REPLIES = {
+    "weather": "抱歉，我无法获取实时天气信息。你可以查看天气预报应用，然后告诉我天气怎么样，我会记录到你的日记中。",
+    "diary": "今天发生了什么有趣的事情吗？可以和我分享一下。",
+    "morning": "上午过得怎么样？完成了哪些事情？",
+    "evening": "下午/晚上有什么特别的经历吗？",
+    "mood": "理解你的感受。还有什么想记录的吗？",
+    "end": "好的，我来帮你整理今天的日记。",
+}
+
+
+class LLMUnavailableError(Exception):
+    """LLM未配置或调用失败（调用方不接受模拟回复时抛出）"""
+
+
+def _last_user_message(messages: List[Dict[str, str]]) -> str:
+    """
+    获取最后一条用户消息内容
+    
+    Args:
+        messages: 消息列表
+        
+    Returns:
+        消息内容，没有用户消息时返回空字符串
+    """
+    # 最后一条通常就是用户消息
+    if messages and messages[-1].get("role") == "user":
+        return messages[-1].get("content", "")
+    for i in range(len(messages) - 2, -1, -1):
+        if messages[i].get("role") == "user":
+            return messages[i].get("content", "")
+    return ""
+
 
 class LLMService:
     """大语言模型服务"""
@@ -22,18 +107,46 @@ class LLMService:
         self.api_base = getattr(settings, 'llm_api_base', 'https://api.openai.com/v1')
         self.model = getattr(settings, 'llm_model', 'gpt-3.5-turbo')
         
+        # 引导问题缓存（缓存key -> (写入时间, 回复)），按写入时间有序
+        self._guide_cache: "OrderedDict[str, tuple]" = OrderedDict()
+        
+        # 日期信息缓存 (缓存失效的时间戳, 日期信息)，在下一个本地零点失效
+        self._date_cache: tuple = (0.0, "")
+        
+        # 长连接复用的HTTP客户端，首次使用时创建
+        self._client: Optional[httpx.AsyncClient] = None
+    
+    async def _client_get(self) -> httpx.AsyncClient:
+        """获取共享的HTTP客户端（连接池 + keep-alive，避免每次请求重新握手）"""
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=30.0,
+                limits=httpx.Limits(max_connections=100, max_keepalive_connections=20)
+            )
+        return self._client
+    
+    async def aclose(self):
+        """关闭共享的HTTP客户端（应用关闭时调用）"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+        
     def get_current_date_info(self) -> str:
         """
-        获取当前日期信息
+        获取当前日期信息，同一天内复用缓存结果
         
         Returns:
             日期信息字符串
         """
-        now = datetime.now()
-        weekdays = ['周一', '周二', '周三', '周四', '周五', '周六', '周日']
-        weekday = weekdays[now.weekday()]
+        expires_at, date_info = self._date_cache
+        if time.time() < expires_at:
+            return date_info
         
-        return f"今天是 {now.strftime('%Y年%m月%d日')} {weekday}"
+        now = datetime.now()
+        date_info = f"今天是 {now.strftime('%Y年%m月%d日')} {_WEEKDAYS[now.weekday()]}"
+        next_midnight = datetime.combine(now.date() + timedelta(days=1), datetime.min.time()).timestamp()
+        self._date_cache = (next_midnight, date_info)
+        return date_info
     
     async def search_web(self, query: str) -> str:
         """
@@ -61,37 +174,41 @@ class LLMService:
             logger.error(f"联网搜索失败: {e}")
             return f"搜索出错: {str(e)}"
     
-    async def chat_with_internet(self, messages: List[Dict[str, str]], temperature: float = 0.7) -> str:
+    async def chat_with_internet(self, messages: List[Dict[str, str]], temperature: float = 0.7,
+                                 max_tokens: int = 500, fallback: bool = True) -> str:
         """
         带联网功能的对话
         
         Args:
             messages: 消息列表
             temperature: 温度参数
+            max_tokens: 回复的最大token数
+            fallback: LLM不可用时是否返回模拟回复，为False时抛出 LLMUnavailableError
             
         Returns:
             LLM回复内容
         """
+        chat = self.chat if fallback else self._chat_api
         # 获取最后一条用户消息
-        last_message = ""
-        for msg in reversed(messages):
-            if msg.get("role") == "user":
-                last_message = msg.get("content", "")
-                break
+        last_message = _last_user_message(messages)
         
         logger.info(f"chat_with_internet 收到消息: {last_message}")
         
         # 判断是否需要联网搜索
-        search_keywords = ['天气', '新闻', '今天', '现在', '最新', '股价', '汇率', '时间', '几号', '日期']
-        need_search = any(keyword in last_message for keyword in search_keywords)
+        need_search = _SEARCH_KEYS_RE.search(last_message) is not None
         
         logger.info(f"是否需要搜索: {need_search}, 消息长度: {len(last_message)}")
         
+        # 纯日期/天气询问直接本地回答，省去一次LLM请求
+        if need_search and len(last_message) < DIRECT_QUERY_MAX_LEN and _DIRECT_QUERY_RE.match(last_message.strip()):
+            logger.info("简单日期/天气询问，直接回答")
+            return await self.search_web(last_message)
+        
         if need_search and len(last_message) < 100:  # 增加长度限制，避免搜索长对话
             # 执行搜索
             logger.info(f"开始联网搜索: {last_message}")
             search_result = await self.search_web(last_message)
-            logger.info(f"搜索结果: {search_result[:200]}...")  # 只打印前200字符
+            logger.debug("搜索结果: %.200s...", search_result)  # 只打印前200字符
             
             # 将搜索结果添加到上下文
             enhanced_messages = messages.copy()
@@ -100,76 +217,104 @@ class LLMService:
                 "content": f"联网搜索结果：{search_result}"
             })
             
-            return await self.chat(enhanced_messages, temperature)
+            return await chat(enhanced_messages, temperature, max_tokens)
         else:
             # 普通对话
             logger.info("使用普通对话模式")
-            return await self.chat(messages, temperature)
+            return await chat(messages, temperature, max_tokens)
         
-    async def chat(self, messages: List[Dict[str, str]], temperature: float = 0.7) -> str:
+    async def chat(self, messages: List[Dict[str, str]], temperature: float = 0.7,
+                   max_tokens: int = 500) -> str:
         """
         与LLM对话
         
         Args:
             messages: 消息列表，格式 [{"role": "user", "content": "..."}]
             temperature: 温度参数，控制创造性
+            max_tokens: 回复的最大token数，短回复设小可降低延迟
             
         Returns:
-            LLM回复内容
+            LLM回复内容，未配置或调用失败时返回模拟回复
         """
         try:
-            if not self.api_key:
-                # 如果没有配置API Key，使用模拟回复
-                return self._mock_response(messages)
+            return await self._chat_api(messages, temperature, max_tokens)
+        except LLMUnavailableError:
+            return self._mock_response(messages)
+    
+    async def _chat_api(self, messages: List[Dict[str, str]], temperature: float = 0.7,
+                        max_tokens: int = 500) -> str:
+        """
+        调用LLM接口对话
+        
+        Args:
+            messages: 消息列表
+            temperature: 温度参数
+            max_tokens: 回复的最大token数
             
-            # 在系统消息中添加当前日期
-            date_info = self.get_current_date_info()
-            enhanced_messages = []
+        Returns:
+            LLM回复内容
             
-            # 找到系统消息并增强
-            has_system = False
-            for msg in messages:
-                if msg.get("role") == "system":
-                    enhanced_msg = msg.copy()
-                    enhanced_msg["content"] = f"{msg['content']}\n\n[{date_info}]"
-                    enhanced_messages.append(enhanced_msg)
-                    has_system = True
-                else:
-                    enhanced_messages.append(msg)
+        Raises:
+            LLMUnavailableError: 未配置API Key或调用失败
+        """
+        if not self.api_key:
+            # 没有配置API Key
+            raise LLMUnavailableError("未配置LLM API Key")
+        
+        try:
+            # 在开头的系统消息中添加当前日期，其余消息原样引用不复制
+            date_info = self.get_current_date_info()
+            if messages and messages[0].get("role") == "system":
+                enhanced_messages = [
+                    {"role": "system", "content": f"{messages[0]['content']}\n\n[{date_info}]"},
+                    *messages[1:]
+                ]
+            else:
+                # 如果没有系统消息，添加一个
+                enhanced_messages = [
+                    {"role": "system", "content": f"你是一个有帮助的助手。{date_info}"},
+                    *messages
+                ]
             
-            # 如果没有系统消息，添加一个
-            if not has_system:
-                enhanced_messages.insert(0, {
-                    "role": "system",
-                    "content": f"你是一个有帮助的助手。{date_info}"
-                })
+            client = await self._client_get()
+            for attempt in range(LLM_MAX_RETRIES + 1):
+                # 限制同时进行的LLM请求数
+                async with _llm_semaphore:
+                    response = await client.post(
+                        f"{self.api_base}/chat/completions",
+                        headers={
+                            "Authorization": f"Bearer {self.api_key}",
+                            "Content-Type": "application/json"
+                        },
+                        content=orjson.dumps({
+                            "model": self.model,
+                            "messages": enhanced_messages,
+                            "temperature": temperature,
+                            "max_tokens": max_tokens
+                        }),
+                        timeout=30.0
+                    )
+                
+                if response.status_code != 429 or attempt == LLM_MAX_RETRIES:
+                    break
+                
+                # 被限流时指数退避并加入随机抖动后重试（等待期间不占用并发名额）
+                delay = LLM_RETRY_BASE_DELAY * (2 ** attempt) + random.uniform(0, LLM_RETRY_BASE_DELAY)
+                logger.warning(f"LLM请求被限流，{delay:.1f}秒后重试 ({attempt + 1}/{LLM_MAX_RETRIES})")
+                await asyncio.sleep(delay)
             
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    f"{self.api_base}/chat/completions",
-                    headers={
-                        "Authorization": f"Bearer {self.api_key}",
-                        "Content-Type": "application/json"
-                    },
-                    json={
-                        "model": self.model,
-                        "messages": enhanced_messages,
-                        "temperature": temperature,
-                        "max_tokens": 500
-                    },
-                    timeout=30.0
-                )
+            if response.status_code == 200:
+                result = orjson.loads(response.content)
+                return result["choices"][0]["message"]["content"]
+            else:
+                logger.error(f"LLM API错误: {response.status_code} - {response.text}")
+                raise LLMUnavailableError(f"LLM API错误: {response.status_code}")
                 
-                if response.status_code == 200:
-                    result = response.json()
-                    return result["choices"][0]["message"]["content"]
-                else:
-                    logger.error(f"LLM API错误: {response.status_code} - {response.text}")
-                    return self._mock_response(messages)
-                    
+        except LLMUnavailableError:
+            raise
         except Exception as e:
             logger.error(f"LLM调用失败: {e}")
-            return self._mock_response(messages)
+            raise LLMUnavailableError(str(e)) from e
     
     def _mock_response(self, messages: List[Dict[str, str]]) -> str:
         """
@@ -182,33 +327,74 @@ class LLMService:
             模拟回复
         """
         # 获取最后一条用户消息
-        last_message = ""
-        for msg in reversed(messages):
-            if msg.get("role") == "user":
-                last_message = msg.get("content", "")
-                break
+        last_message = _last_user_message(messages)
         
-        # 检查是否是天气查询
-        if "天气" in last_message:
-            return "抱歉，我无法获取实时天气信息。你可以查看天气预报应用，然后告诉我天气怎么样，我会记录到你的日记中。"
+        # 一次扫描找出优先级最高的关键词类别
+        best = len(_MOCK_ORDER)
+        for m in _MOCK_RE.finditer(last_message):
+            rank = _MOCK_RANK[m.lastgroup]
+            if rank < best:
+                best = rank
+                if rank == 0:
+                    break
+        
+        if best == len(_MOCK_ORDER):
+            return "嗯，我明白了。还有其他想分享的吗？"
         
-        # 检查是否是时间/日期查询
-        if "时间" in last_message or "日期" in last_message or "今天几号" in last_message:
+        key = _MOCK_ORDER[best]
+        # 时间/日期查询
+        if key == "time":
             return f"{self.get_current_date_info()}。有什么想记录的吗？"
+        return _MOCK_REPLIES[key]
+    
+    def _guide_cache_key(self, context: List[Dict[str, str]], date_info: str) -> str:
+        """
+        计算引导问题缓存key
+        只取最近几轮对话，并带上日期信息，避免跨天命中
         
-        # 简单的模拟回复逻辑
-        if "今天" in last_message or "日记" in last_message:
-            return "今天发生了什么有趣的事情吗？可以和我分享一下。"
-        elif "早上" in last_message or "上午" in last_message:
-            return "上午过得怎么样？完成了哪些事情？"
-        elif "下午" in last_message or "晚上" in last_message:
-            return "下午/晚上有什么特别的经历吗？"
-        elif "心情" in last_message or "感觉" in last_message:
-            return "理解你的感受。还有什么想记录的吗？"
-        elif "结束" in last_message or "完成" in last_message or "整理" in last_message:
-            return "好的，我来帮你整理今天的日记。"
-        else:
-            return "嗯，我明白了。还有其他想分享的吗？"
+        Args:
+            context: 对话上下文
+            date_info: 日期信息
+            
+        Returns:
+            缓存key
+        """
+        payload = orjson.dumps([date_info, context[-GUIDE_CACHE_TURNS:]])
+        return hashlib.sha256(payload).hexdigest()
+    
+    def _get_cached_guide(self, key: str) -> Optional[str]:
+        """
+        读取未过期的引导问题缓存
+        
+        Args:
+            key: 缓存key
+            
+        Returns:
+            缓存的回复，未命中返回None
+        """
+        current_time = time.time()
+        
+        # 清理过期记录（从最旧的一端开始）
+        while self._guide_cache:
+            oldest_time, _ = next(iter(self._guide_cache.values()))
+            if current_time - oldest_time <= GUIDE_CACHE_TTL:
+                break
+            self._guide_cache.popitem(last=False)
+        
+        cached = self._guide_cache.get(key)
+        return cached[1] if cached else None
+    
+    def _set_cached_guide(self, key: str, reply: str):
+        """
+        写入引导问题缓存
+        
+        Args:
+            key: 缓存key
+            reply: 回复内容
+        """
+        self._guide_cache[key] = (time.time(), reply)
+        while len(self._guide_cache) > GUIDE_CACHE_SIZE:
+            self._guide_cache.popitem(last=False)
     
     async def generate_guide_question(self, context: List[Dict[str, str]]) -> str:
         """
@@ -222,6 +408,13 @@ class LLMService:
         """
         date_info = self.get_current_date_info()
         
+        # 相同的近期对话直接返回缓存的回复
+        cache_key = self._guide_cache_key(context, date_info)
+        cached_reply = self._get_cached_guide(cache_key)
+        if cached_reply is not None:
+            logger.info("引导问题命中缓存")
+            return cached_reply
+        
         system_prompt = f"""你是一个贴心的日记助手。
 
 {date_info}
@@ -247,7 +440,15 @@ class LLMService:
         ]
         
         # 使用带联网功能的对话
-        return await self.chat_with_internet(messages, temperature=0.8)
+        # 回复不超过30个字，无需预留500个token
+        try:
+            reply = await self.chat_with_internet(messages, temperature=0.8, max_tokens=GUIDE_MAX_TOKENS,
+                                                  fallback=False)
+        except LLMUnavailableError:
+            # 模拟回复不写入缓存，LLM恢复后相同的对话能立即得到真实回复
+            return self._mock_response(messages)
+        self._set_cached_guide(cache_key, reply)
+        return reply
     
     async def generate_diary(self, context: List[Dict[str, str]]) -> str:
         """
@@ -313,11 +514,8 @@ class LLMService:
             "should_generate_diary": False
         }
         
-        message_lower = message.lower()
-        
-        # 判断是否是结束对话（添加更多关键词）
-        end_keywords = ["结束", "完成", "整理", "生成日记", "好了", "就这样", "总结", "帮我总结", "整理日记"]
-        if any(keyword in message_lower for keyword in end_keywords):
+        # 判断是否是结束对话（关键词均为中文，无需转小写）
+        if _END_KEYS_RE.search(message):
             intent["type"] = "end"
             intent["should_generate_diary"] = True
         
@@ -3,16 +3,109 @@
 在生成日记时下载图片并上传到飞书文档
 """
 
+import asyncio
+import secrets
+import orjson
 import httpx
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple
 from src.utils.config import settings
 from src.utils.logger import logger
+from src.services.feishu_doc_service import FEISHU_API_BASE, feishu_doc_service
+from src.utils.token_cache import INVALID_TOKEN_CODES
+
+# 同时下载/上传的图片数量上限，避免触发飞书接口限流
+MEDIA_MAX_CONCURRENCY = 8
+
+# 流式转发图片时每次读取的字节数
+STREAM_CHUNK_SIZE = 65536
+
+
+def _image_multipart(file_name: str) -> Tuple[str, bytes, bytes]:
+    """
+    构造只含一个图片字段的 multipart 请求体首尾（图片数据夹在中间）
+    
+    Args:
+        file_name: 文件名
+        
+    Returns:
+        (Content-Type 请求头, 图片数据前的部分, 图片数据后的部分)
+    """
+    boundary = secrets.token_hex(16)
+    safe_name = file_name.replace('"', '%22')
+    head = (
+        f'--{boundary}\r\n'
+        f'Content-Disposition: form-data; name="image"; filename="{safe_name}"\r\n'
+        f'Content-Type: image/jpeg\r\n\r\n'
+    ).encode('utf-8')
+    tail = f'\r\n--{boundary}--\r\n'.encode('utf-8')
+    return f"multipart/form-data; boundary={boundary}", head, tail
+
+
+def _token_rejected(content: bytes) -> bool:
+    """飞书响应体是否表示 access_token 无效/过期"""
+    try:
+        result = orjson.loads(content)
+    except orjson.JSONDecodeError:
+        return False
+    return isinstance(result, dict) and result.get("code") in INVALID_TOKEN_CODES
 
 
 class MediaProcessService:
     """媒体处理服务"""
     
-    async def download_image(self, image_key: str, access_token: str) -> Optional[bytes]:
+    def __init__(self):
+        """初始化媒体处理服务"""
+        # 长连接复用的HTTP客户端，首次使用时创建
+        self._client: Optional[httpx.AsyncClient] = None
+    
+    async def _client_get(self) -> httpx.AsyncClient:
+        """获取共享的HTTP客户端（HTTP/2 多路复用 + keep-alive，避免每张图片重新握手）"""
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=FEISHU_API_BASE,
+                http2=True,
+                timeout=30.0,
+                limits=httpx.Limits(
+                    max_connections=settings.feishu_http_max_connections,
+                    max_keepalive_connections=settings.feishu_http_max_keepalive,
+                    keepalive_expiry=settings.feishu_http_keepalive_expiry
+                )
+            )
+        return self._client
+    
+    async def aclose(self):
+        """关闭共享的HTTP客户端（应用关闭时调用）"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+    
+    async def _refresh_token(self, access_token: str) -> Optional[str]:
+        """
+        丢弃被飞书拒绝的缓存令牌并重新获取
+        
+        Args:
+            access_token: 被拒绝的令牌
+            
+        Returns:
+            新令牌，获取失败或与原令牌相同时返回None（不再重试）
+        """
+        feishu_doc_service.token_cache.invalidate(access_token)
+        new_token = await feishu_doc_service.token_cache.get()
+        if not new_token or new_token == access_token:
+            return None
+        logger.warning("tenant_access_token已失效，刷新后重试")
+        return new_token
+    
+    async def _get_image(self, image_key: str, access_token: str) -> httpx.Response:
+        """请求图片下载接口"""
+        client = await self._client_get()
+        return await client.get(
+            f"/open-apis/im/v1/images/{image_key}",
+            headers={"Authorization": f"Bearer {access_token}"},
+            timeout=30.0
+        )
+    
+    async def download_image(self, image_key: str, access_token: Optional[str] = None) -> Optional[bytes]:
         """
         下载图片
         使用飞书图片下载API: GET /open-apis/im/v1/images/{image_key}
@@ -20,132 +113,254 @@ class MediaProcessService:
         
         Args:
             image_key: 图片key
-            access_token: 飞书访问令牌
+            access_token: 飞书访问令牌，为空时使用共享缓存的 tenant_access_token
             
         Returns:
             图片二进制数据
         """
         try:
-            async with httpx.AsyncClient() as client:
-                # 直接下载图片
-                response = await client.get(
-                    f"https://open.feishu.cn/open-apis/im/v1/images/{image_key}",
-                    headers={"Authorization": f"Bearer {access_token}"},
-                    timeout=30.0
-                )
-                
-                logger.info(f"下载图片API响应: {response.status_code}")
+            access_token = access_token or await feishu_doc_service.token_cache.get()
+            # 直接下载图片，令牌被拒绝时刷新后重试一次
+            response = await self._get_image(image_key, access_token)
+            if response.status_code != 200 and _token_rejected(response.content):
+                new_token = await self._refresh_token(access_token)
+                if new_token:
+                    response = await self._get_image(image_key, new_token)
+            
+            logger.info(f"下载图片API响应: {response.status_code}")
+            
+            if response.status_code == 200:
+                logger.info(f"图片下载成功: {len(response.content)} bytes")
+                return response.content
+            else:
+                logger.error(f"图片下载失败: {response.status_code}, 响应: {response.text[:200]}")
+                return None
                 
-                if response.status_code == 200:
-                    logger.info(f"图片下载成功: {len(response.content)} bytes")
-                    return response.content
-                else:
-                    logger.error(f"图片下载失败: {response.status_code}, 响应: {response.text[:200]}")
-                    return None
-                    
         except Exception as e:
             logger.error(f"下载图片异常: {e}")
             return None
     
-    async def upload_image_to_document(self, image_data: bytes, file_name: str, access_token: str) -> Optional[str]:
+    async def upload_image_to_document(self, image_data: bytes, file_name: str,
+                                      access_token: Optional[str] = None) -> Optional[str]:
         """
         上传图片到飞书文档
         
         Args:
             image_data: 图片二进制数据
             file_name: 文件名
-            access_token: 飞书访问令牌
+            access_token: 飞书访问令牌，为空时使用共享缓存的 tenant_access_token
             
         Returns:
             上传后的图片URL
         """
         try:
-            # 先上传图片素材
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    "https://open.feishu.cn/open-apis/im/v1/images",
-                    headers={"Authorization": f"Bearer {access_token}"},
-                    files={"image": (file_name, image_data, "image/jpeg")},
+            access_token = access_token or await feishu_doc_service.token_cache.get()
+            # 先上传图片素材（multipart 请求体直接拼好，不经过 httpx 的表单编码）
+            content_type, head, tail = _image_multipart(file_name)
+            content = b"".join((head, image_data, tail))
+            client = await self._client_get()
+            
+            async def post(token: str) -> httpx.Response:
+                return await client.post(
+                    "/open-apis/im/v1/images",
+                    headers={"Authorization": f"Bearer {token}", "Content-Type": content_type},
+                    content=content,
                     timeout=30.0
                 )
-                
-                if response.status_code == 200:
-                    result = response.json()
-                    if result.get("code") == 0:
-                        image_key = result["data"]["image_key"]
-                        logger.info(f"图片上传成功: {image_key}")
-                        return image_key
-                    else:
-                        logger.error(f"图片上传失败: {result}")
-                        return None
+            
+            response = await post(access_token)
+            # 请求体已完整在内存中，令牌被拒绝时刷新后重发一次
+            if _token_rejected(response.content):
+                new_token = await self._refresh_token(access_token)
+                if new_token:
+                    response = await post(new_token)
+            
+            if response.status_code == 200:
+                result = orjson.loads(response.content)
+                if result.get("code") == 0:
+                    image_key = result["data"]["image_key"]
+                    logger.info(f"图片上传成功: {image_key}")
+                    return image_key
                 else:
-                    logger.error(f"图片上传请求失败: {response.status_code}")
+                    logger.error(f"图片上传失败: {result}")
                     return None
-                    
+            else:
+                logger.error(f"图片上传请求失败: {response.status_code}")
+                return None
+                
         except Exception as e:
             logger.error(f"上传图片异常: {e}")
             return None
     
-    async def process_media_for_diary(self, media_list: List[Dict[str, Any]], access_token: str) -> List[Dict[str, Any]]:
+    async def download_and_reupload(self, image_key: str, file_name: str,
+                                    access_token: Optional[str] = None) -> Tuple[Optional[str], str]:
         """
-        处理日记中的所有媒体文件
-        简化方案：直接使用原有的 image_key，不再下载上传
+        边下载边上传图片：下载响应按块直接写入上传请求体，不在内存中缓存整张图片
         
         Args:
-            media_list: 媒体文件列表
-            access_token: 飞书访问令牌
+            image_key: 图片key
+            file_name: 文件名
+            access_token: 飞书访问令牌，为空时使用共享缓存的 tenant_access_token
             
         Returns:
-            处理后的媒体列表
+            (上传后的图片key, 处理状态 uploaded/download_failed/upload_failed)
         """
-        processed_media = []
+        access_token = access_token or await feishu_doc_service.token_cache.get()
+        new_key, status = await self._reupload_once(image_key, file_name, access_token)
+        # 下载时令牌被拒绝（此时还未开始上传），刷新令牌后整体重试一次
+        if status == "auth_failed":
+            new_token = await self._refresh_token(access_token)
+            if new_token:
+                new_key, status = await self._reupload_once(image_key, file_name, new_token)
+        if status == "auth_failed":
+            status = "download_failed"
+        return new_key, status
+    
+    async def _reupload_once(self, image_key: str, file_name: str,
+                             access_token: str) -> Tuple[Optional[str], str]:
+        """
+        执行一次边下载边上传
         
-        for media in media_list:
-            if media.get("type") == "image":
-                image_key = media.get("image_key")
-                file_name = media.get("file_name", "image.jpg")
+        Args:
+            image_key: 图片key
+            file_name: 文件名
+            access_token: 飞书访问令牌
+            
+        Returns:
+            (上传后的图片key, 处理状态 uploaded/download_failed/upload_failed，下载时令牌被拒绝为 auth_failed)
+        """
+        auth = {"Authorization": f"Bearer {access_token}"}
+        try:
+            client = await self._client_get()
+            async with client.stream(
+                "GET",
+                f"/open-apis/im/v1/images/{image_key}",
+                headers=auth,
+                timeout=30.0
+            ) as download:
+                logger.info(f"下载图片API响应: {download.status_code}")
+                
+                if download.status_code != 200:
+                    await download.aread()
+                    logger.error(f"图片下载失败: {download.status_code}, 响应: {download.text[:200]}")
+                    if _token_rejected(download.content):
+                        return None, "auth_failed"
+                    return None, "download_failed"
                 
-                if not image_key:
-                    logger.error("图片没有 image_key")
-                    processed_media.append({
-                        **media,
-                        "status": "no_image_key"
-                    })
-                    continue
+                # 手工构造 multipart 请求体，图片部分直接来自下载流
+                content_type, head, tail = _image_multipart(file_name)
                 
-                logger.info(f"处理图片: {file_name}, image_key: {image_key}")
+                async def body():
+                    yield head
+                    async for chunk in download.aiter_bytes(STREAM_CHUNK_SIZE):
+                        yield chunk
+                    yield tail
                 
-                # 下载图片
-                image_data = await self.download_image(image_key, access_token)
+                headers = {**auth, "Content-Type": content_type}
+                # 已知图片大小（且未经压缩编码）时给出总长度，否则使用分块传输
+                length = download.headers.get("Content-Length", "")
+                if length.isdigit() and "Content-Encoding" not in download.headers:
+                    headers["Content-Length"] = str(len(head) + int(length) + len(tail))
                 
-                if image_data:
-                    # 上传到飞书文档获取 file_token
-                    file_token = await self.upload_image_to_document(image_data, file_name, access_token)
-                    
-                    if file_token:
-                        processed_media.append({
-                            "type": "image",
-                            "file_name": file_name,
-                            "image_key": image_key,
-                            "file_token": file_token,
-                            "status": "uploaded"
-                        })
-                    else:
-                        processed_media.append({
-                            **media,
-                            "status": "upload_failed"
-                        })
+                response = await client.post(
+                    "/open-apis/im/v1/images",
+                    headers=headers,
+                    content=body(),
+                    timeout=30.0
+                )
+            
+            if response.status_code == 200:
+                result = orjson.loads(response.content)
+                if result.get("code") == 0:
+                    image_key = result["data"]["image_key"]
+                    logger.info(f"图片上传成功: {image_key}")
+                    return image_key, "uploaded"
                 else:
-                    processed_media.append({
-                        **media,
-                        "status": "download_failed"
-                    })
+                    logger.error(f"图片上传失败: {result}")
+                    return None, "upload_failed"
             else:
-                # 其他类型直接保留
-                processed_media.append(media)
+                logger.error(f"图片上传请求失败: {response.status_code}")
+                return None, "upload_failed"
+                
+        except Exception as e:
+            logger.error(f"转存图片异常: {e}")
+            return None, "upload_failed"
+    
+    async def process_media_for_diary(self, media_list: List[Dict[str, Any]],
+                                      access_token: Optional[str] = None) -> List[Dict[str, Any]]:
+        """
+        处理日记中的所有媒体文件
+        简化方案：直接使用原有的 image_key，不再下载上传
+        
+        Args:
+            media_list: 媒体文件列表
+            access_token: 飞书访问令牌，为空时使用共享缓存的 tenant_access_token
+            
+        Returns:
+            处理后的媒体列表
+        """
+        access_token = access_token or await feishu_doc_service.token_cache.get()
+        # 各图片的下载和上传并发进行，gather 按输入顺序返回结果
+        sem = asyncio.Semaphore(MEDIA_MAX_CONCURRENCY)
+        results = await asyncio.gather(
+            *[self._process_one(media, access_token, sem) for media in media_list],
+            return_exceptions=True
+        )
+        
+        processed_media = []
+        for media, result in zip(media_list, results):
+            if isinstance(result, Exception):
+                logger.error(f"处理图片异常: {result}")
+                result = {**media, "status": "download_failed"}
+            processed_media.append(result)
         
         return processed_media
-
+    
+    async def _process_one(self, media: Dict[str, Any], access_token: str, sem: asyncio.Semaphore) -> Dict[str, Any]:
+        """
+        处理单个媒体文件：下载图片并重新上传
+        
+        Args:
+            media: 媒体文件信息
+            access_token: 飞书访问令牌
+            sem: 限制同时处理的图片数量
+            
+        Returns:
+            处理后的媒体信息
+        """
+        if media.get("type") != "image":
+            # 其他类型直接保留
+            return media
+        
+        image_key = media.get("image_key")
+        file_name = media.get("file_name", "image.jpg")
+        
+        if not image_key:
+            logger.error("图片没有 image_key")
+            return {
+                **media,
+                "status": "no_image_key"
+            }
+        
+        logger.info(f"处理图片: {file_name}, image_key: {image_key}")
+        
+        async with sem:
+            # 下载图片并直接转存到飞书获取 file_token
+            file_token, status = await self.download_and_reupload(image_key, file_name, access_token)
+        
+        if not file_token:
+            return {
+                **media,
+                "status": status
+            }
+        
+        return {
+            "type": "image",
+            "file_name": file_name,
+            "image_key": image_key,
+            "file_token": file_token,
+            "status": "uploaded"
+        }
 
 # 创建全局媒体处理服务实例
 media_process_service = MediaProcessService()
@@ -3,11 +3,32 @@
 用于向飞书用户发送消息
 """
 
-import json
-from typing import Dict, Any, Optional
+import logging
+import orjson
+from typing import Dict, Any, Optional, Tuple
 import httpx
 from src.utils.config import settings
 from src.utils.logger import logger
+from src.utils.token_cache import TokenCache, INVALID_TOKEN_CODES
+from src.services.feishu_doc_service import FEISHU_API_BASE
+
+# app_access_token 提前刷新的秒数
+TOKEN_REFRESH_MARGIN = 300
+
+# 飞书消息接口路径（相对于 FEISHU_API_BASE）
+_TOKEN_URL = "/open-apis/auth/v3/app_access_token/internal"
+_SEND_URL = "/open-apis/im/v1/messages"
+_REPLY_URL_TMPL = "/open-apis/im/v1/messages/{}/reply"
+_SEND_PARAMS = {"receive_id_type": "open_id"}
+
+
+def _parse_json(response: httpx.Response) -> Dict[str, Any]:
+    """解析响应体JSON（只解析一次，供结果判断和日志共用），非JSON响应返回空字典"""
+    try:
+        result = orjson.loads(response.content)
+    except orjson.JSONDecodeError:
+        return {}
+    return result if isinstance(result, dict) else {}
 
 
 class MessageService:
@@ -17,38 +38,115 @@ class MessageService:
         """初始化消息服务"""
         self.app_id = settings.feishu_app_id
         self.app_secret = settings.feishu_app_secret
-        self.access_token = None
+        # 长连接复用的HTTP客户端，首次使用时创建
+        self._client: Optional[httpx.AsyncClient] = None
+        # app_access_token 缓存
+        self._token_cache = TokenCache(self._fetch_access_token, TOKEN_REFRESH_MARGIN)
+        # 按当前 token 缓存的请求头，token 刷新后重建
+        self._headers_token: Optional[str] = None
+        self._headers: Dict[str, str] = {}
+    
+    def _auth_headers(self, token: str) -> Dict[str, str]:
+        """
+        获取带鉴权的请求头（同一 token 复用同一个字典）
+        
+        Args:
+            token: access_token
+            
+        Returns:
+            请求头字典
+        """
+        if token != self._headers_token:
+            self._headers = {
+                "Authorization": f"Bearer {token}",
+                "Content-Type": "application/json"
+            }
+            self._headers_token = token
+        return self._headers
+    
+    async def _client_get(self) -> httpx.AsyncClient:
+        """获取共享的HTTP客户端（HTTP/2 多路复用 + keep-alive，避免每条消息重新握手）"""
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=FEISHU_API_BASE,
+                http2=True,
+                limits=httpx.Limits(
+                    max_connections=settings.feishu_http_max_connections,
+                    max_keepalive_connections=settings.feishu_http_max_keepalive,
+                    keepalive_expiry=settings.feishu_http_keepalive_expiry
+                )
+            )
+        return self._client
+    
+    async def aclose(self):
+        """关闭共享的HTTP客户端（应用关闭时调用）"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
     
     async def _get_access_token(self) -> str:
         """
-        获取飞书访问令牌
+        获取飞书访问令牌（缓存至过期前 TOKEN_REFRESH_MARGIN 秒）
         
         Returns:
             access_token
         """
+        return await self._token_cache.get()
+    
+    async def _fetch_access_token(self) -> Tuple[str, float]:
+        """请求新的访问令牌，返回 (token, 有效秒数)"""
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    "https://open.feishu.cn/open-apis/auth/v3/app_access_token/internal",
-                    json={
-                        "app_id": self.app_id,
-                        "app_secret": self.app_secret
-                    }
-                )
-                
-                if response.status_code == 200:
-                    result = response.json()
-                    if result.get("code") == 0:
-                        return result["app_access_token"]
-                    else:
-                        logger.error(f"获取token失败: {result}")
-                        return ""
+            client = await self._client_get()
+            response = await client.post(
+                _TOKEN_URL,
+                headers={"Content-Type": "application/json"},
+                content=orjson.dumps({
+                    "app_id": self.app_id,
+                    "app_secret": self.app_secret
+                })
+            )
+            
+            if response.status_code == 200:
+                result = orjson.loads(response.content)
+                if result.get("code") == 0:
+                    return result["app_access_token"], result.get("expire", 0)
                 else:
-                    logger.error(f"获取token请求失败: {response.status_code}")
-                    return ""
+                    logger.error(f"获取token失败: {result}")
+                    return "", 0
+            else:
+                logger.error(f"获取token请求失败: {response.status_code}")
+                return "", 0
         except Exception as e:
             logger.error(f"获取token异常: {e}")
-            return ""
+            return "", 0
+    
+    async def _post(self, url: str, token: str, payload: Dict[str, Any],
+                    params: Optional[Dict[str, str]] = None) -> Tuple[httpx.Response, Dict[str, Any]]:
+        """
+        带鉴权发送POST请求，token 被判定失效时丢弃缓存，换新 token 重试一次
+        
+        Args:
+            url: 接口路径
+            token: access_token
+            payload: JSON请求体
+            params: 查询参数
+            
+        Returns:
+            (最后一次的响应, 解析后的响应JSON)
+        """
+        client = await self._client_get()
+        body = orjson.dumps(payload)
+        response = await client.post(url, params=params, headers=self._auth_headers(token), content=body)
+        result = _parse_json(response)
+        
+        if result.get("code") in INVALID_TOKEN_CODES:
+            self._token_cache.invalidate(token)
+            new_token = await self._get_access_token()
+            if new_token and new_token != token:
+                logger.warning(f"access_token已失效({result.get('code')})，刷新后重试")
+                response = await client.post(url, params=params, headers=self._auth_headers(new_token), content=body)
+                result = _parse_json(response)
+        return response, result
     
     async def send_text_message(self, user_id: str, text: str) -> Dict[str, Any]:
         """
@@ -69,47 +167,39 @@ class MessageService:
                 return {"code": 1, "msg": "无法获取access_token"}
             
             # 构建消息内容
-            content = json.dumps({"text": text})
+            content = orjson.dumps({"text": text}).decode()
             
             # 调用飞书API发送消息
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    "https://open.feishu.cn/open-apis/im/v1/messages",
-                    params={"receive_id_type": "open_id"},
-                    headers={
-                        "Authorization": f"Bearer {token}",
-                        "Content-Type": "application/json"
-                    },
-                    json={
-                        "receive_id": user_id,
-                        "content": content,
-                        "msg_type": "text"
+            response, result = await self._post(_SEND_URL, token, {
+                "receive_id": user_id,
+                "content": content,
+                "msg_type": "text"
+            }, params=_SEND_PARAMS)
+            
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("发送消息API响应: %s - %.500s", response.status_code, result)
+            
+            if response.status_code == 200:
+                if result.get("code") == 0:
+                    logger.info(f"消息发送成功: {user_id}")
+                    return {
+                        "code": 0,
+                        "msg": "消息发送成功",
+                        "data": result.get("data", {})
                     }
-                )
-                
-                logger.info(f"发送消息API响应: {response.status_code} - {response.text}")
-                
-                if response.status_code == 200:
-                    result = response.json()
-                    if result.get("code") == 0:
-                        logger.info(f"消息发送成功: {user_id}")
-                        return {
-                            "code": 0,
-                            "msg": "消息发送成功",
-                            "data": result.get("data", {})
-                        }
-                    else:
-                        logger.error(f"消息发送失败: {result}")
-                        return {
-                            "code": 1,
-                            "msg": f"发送失败: {result.get('msg', '未知错误')}"
-                        }
                 else:
-                    logger.error(f"消息发送请求失败: {response.status_code} - {response.text}")
+                    logger.error(f"消息发送失败: {result}")
                     return {
                         "code": 1,
-                        "msg": f"请求失败: {response.status_code}"
+                        "msg": f"发送失败: {result.get('msg', '未知错误')}"
                     }
+            else:
+                # 飞书的错误响应一般也是JSON，解析失败时才退回原始文本
+                logger.error(f"消息发送请求失败: {response.status_code} - {result or response.text}")
+                return {
+                    "code": 1,
+                    "msg": f"请求失败: {response.status_code}"
+                }
             
         except Exception as e:
             logger.error(f"发送消息异常: {e}")
@@ -133,33 +223,24 @@ class MessageService:
                 return {"code": 1, "msg": "无法获取access_token"}
             
             # 构建消息内容
-            content = json.dumps({"text": text})
+            content = orjson.dumps({"text": text}).decode()
             
             # 调用飞书API回复消息
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    f"https://open.feishu.cn/open-apis/im/v1/messages/{message_id}/reply",
-                    headers={
-                        "Authorization": f"Bearer {token}",
-                        "Content-Type": "application/json"
-                    },
-                    json={
-                        "content": content,
-                        "msg_type": "text"
-                    }
-                )
-                
-                if response.status_code == 200:
-                    result = response.json()
-                    if result.get("code") == 0:
-                        logger.info(f"消息回复成功: {message_id}")
-                        return {"code": 0, "msg": "回复成功"}
-                    else:
-                        logger.error(f"消息回复失败: {result}")
-                        return {"code": 1, "msg": f"回复失败: {result.get('msg', '未知错误')}"}
+            response, result = await self._post(_REPLY_URL_TMPL.format(message_id), token, {
+                "content": content,
+                "msg_type": "text"
+            })
+            
+            if response.status_code == 200:
+                if result.get("code") == 0:
+                    logger.info(f"消息回复成功: {message_id}")
+                    return {"code": 0, "msg": "回复成功"}
                 else:
-                    logger.error(f"消息回复请求失败: {response.status_code}")
-                    return {"code": 1, "msg": f"请求失败: {response.status_code}"}
+                    logger.error(f"消息回复失败: {result}")
+                    return {"code": 1, "msg": f"回复失败: {result.get('msg', '未知错误')}"}
+            else:
+                logger.error(f"消息回复请求失败: {response.status_code}")
+                return {"code": 1, "msg": f"请求失败: {response.status_code}"}
             
         except Exception as e:
             logger.error(f"回复消息异常: {e}")
@@ -3,7 +3,7 @@
 管理应用的所有配置信息，包括飞书配置、服务器配置、数据库配置等
 """
 
-from pydantic_settings import BaseSettings
+from pydantic_settings import BaseSettings, SettingsConfigDict
 from functools import lru_cache
 
 
@@ -16,6 +16,11 @@ class Settings(BaseSettings):
     feishu_verification_token: str = ""
     feishu_encrypt_key: str = ""
     
+    # 飞书API连接池：过小会让并发的图片上传排队，过大则浪费文件描述符和TLS会话
+    feishu_http_max_connections: int = 32
+    feishu_http_max_keepalive: int = 16
+    feishu_http_keepalive_expiry: float = 60.0
+    
     # 服务器配置
     host: str = "0.0.0.0"
     port: int = 8000
@@ -23,23 +28,28 @@ class Settings(BaseSettings):
     # 数据库配置
     database_url: str = "sqlite:///./feishu_diary.db"
     
+    # Redis配置（可选，配置后用于多进程消息去重）
+    # 多 worker 部署必须配置；配置后视为多进程部署，进程内会话缓存自动关闭
+    redis_url: str = ""
+    
     # 日志配置
     log_level: str = "INFO"
     log_file: str = "logs/app.log"
+    log_max_bytes: int = 10 * 1024 * 1024  # 单个日志文件大小上限，超过后轮转
+    log_backup_count: int = 5  # 保留的历史日志文件数
     
     # LLM 配置（支持 OpenAI 和 SiliconFlow）
     llm_api_key: str = ""
     llm_api_base: str = "https://api.openai.com/v1"
     llm_model: str = "gpt-3.5-turbo"
+    llm_max_async: int = 4  # 同时进行的LLM请求上限
     
     # 应用配置
     app_name: str = "Feishu Diary Bot"
     app_version: str = "1.0.0"
     debug: bool = False
     
-    class Config:
-        env_file = ".env"
-        env_file_encoding = "utf-8"
+    model_config = SettingsConfigDict(env_file=".env", env_file_encoding="utf-8")
 
 
 @lru_cache()
@@ -4,12 +4,68 @@
 """
 
 import sqlite3
+import threading
 from datetime import datetime
 from pathlib import Path
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Set
 from .config import settings
 from .logger import logger
 
+# 每个连接都需要设置的 PRAGMA（journal_mode 是持久化到数据库文件的，只在初始化时设置一次）
+CONNECTION_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-20000",
+    "PRAGMA mmap_size=268435456",
+)
+
+# 已确认存在的数据库目录（同一进程内多次初始化时不再 mkdir）
+_ready_dirs: Set[Path] = set()
+
+
+# 数据库表结构（表和索引，用于热启动时判断结构是否完整）
+SCHEMA_OBJECTS = ("diary", "media", "user_config", "idx_diary_user_time", "idx_media_diary")
+SCHEMA_SQL = """
+BEGIN;
+
+-- 日记表
+CREATE TABLE IF NOT EXISTS diary (
+    id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    content TEXT NOT NULL,
+    create_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    update_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    category TEXT,
+    document_url TEXT
+);
+
+-- 媒体文件表
+CREATE TABLE IF NOT EXISTS media (
+    id TEXT PRIMARY KEY,
+    diary_id TEXT NOT NULL,
+    file_name TEXT NOT NULL,
+    file_type TEXT NOT NULL,
+    file_url TEXT NOT NULL,
+    upload_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (diary_id) REFERENCES diary(id)
+);
+
+-- 用户配置表
+CREATE TABLE IF NOT EXISTS user_config (
+    user_id TEXT PRIMARY KEY,
+    template TEXT,
+    document_structure TEXT,
+    preferences TEXT,
+    update_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- 按用户查询日记列表、按日记查询媒体文件
+CREATE INDEX IF NOT EXISTS idx_diary_user_time ON diary(user_id, create_time DESC);
+CREATE INDEX IF NOT EXISTS idx_media_diary ON media(diary_id);
+
+COMMIT;
+"""
+
 
 class Database:
     """数据库管理类"""
@@ -23,6 +79,11 @@ class Database:
         """
         self.db_url = db_url or settings.database_url
         self.db_path = self._parse_db_path()
+        self.is_memory = self.db_path == ":memory:" or self.db_path.startswith("file::memory:")
+        # 每个线程复用一个长连接（同一连接跨线程交错使用会混淆事务）
+        self._local = threading.local()
+        self._conns: List[sqlite3.Connection] = []
+        self._conns_lock = threading.Lock()
         self._init_db()
     
     def _parse_db_path(self) -> str:
@@ -33,59 +94,58 @@ class Database:
     
     def _init_db(self):
         """初始化数据库，创建必要的表"""
-        # 确保数据库目录存在
-        db_dir = Path(self.db_path).parent
-        db_dir.mkdir(parents=True, exist_ok=True)
+        # 确保数据库目录存在（内存数据库没有目录）
+        if not self.is_memory:
+            db_dir = Path(self.db_path).parent
+            if db_dir not in _ready_dirs:
+                db_dir.mkdir(parents=True, exist_ok=True)
+                _ready_dirs.add(db_dir)
         
         with self.get_connection() as conn:
             cursor = conn.cursor()
             
-            # 创建日记表
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS diary (
-                    id TEXT PRIMARY KEY,
-                    user_id TEXT NOT NULL,
-                    content TEXT NOT NULL,
-                    create_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    update_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    category TEXT,
-                    document_url TEXT
-                )
-            """)
+            # 启用WAL模式：读不阻塞写，每次提交更少的fsync（内存数据库不支持WAL）
+            if not self.is_memory:
+                cursor.execute("PRAGMA journal_mode=WAL")
             
-            # 创建媒体文件表
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS media (
-                    id TEXT PRIMARY KEY,
-                    diary_id TEXT NOT NULL,
-                    file_name TEXT NOT NULL,
-                    file_type TEXT NOT NULL,
-                    file_url TEXT NOT NULL,
-                    upload_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (diary_id) REFERENCES diary(id)
-                )
-            """)
+            # 热启动时表和索引已全部存在，跳过建表（旧库缺少索引时会补建）
+            cursor.execute(
+                "SELECT count(*) FROM sqlite_master WHERE type IN ('table', 'index') AND name IN (%s)"
+                % ",".join("?" * len(SCHEMA_OBJECTS)),
+                SCHEMA_OBJECTS
+            )
+            if cursor.fetchone()[0] < len(SCHEMA_OBJECTS):
+                # 建表语句放在一个事务里一次执行（journal_mode 不能在事务中修改，需在此之前执行）
+                conn.executescript(SCHEMA_SQL)
             
-            # 创建用户配置表
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS user_config (
-                    user_id TEXT PRIMARY KEY,
-                    template TEXT,
-                    document_structure TEXT,
-                    preferences TEXT,
-                    update_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-            
-            conn.commit()
             logger.info("数据库初始化完成")
     
+    def _connect(self) -> sqlite3.Connection:
+        """创建新的数据库连接"""
+        # check_same_thread=False 只是为了关闭时能在主线程统一 close，连接本身只在所属线程中使用
+        conn = sqlite3.connect(self.db_path, cached_statements=256, check_same_thread=False)
+        if not self.is_memory:
+            for pragma in CONNECTION_PRAGMAS:
+                conn.execute(pragma)
+        return conn
+    
     def get_connection(self):
-        """获取数据库连接"""
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
+        """获取当前线程的数据库长连接（首次调用时创建），语句缓存和页缓存跨调用复用"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+            with self._conns_lock:
+                self._conns.append(conn)
         return conn
     
+    def close(self):
+        """关闭所有线程的数据库连接（应用关闭时调用）"""
+        with self._conns_lock:
+            conns, self._conns = self._conns, []
+        for conn in conns:
+            conn.close()
+    
     def execute(self, query: str, params: tuple = ()) -> int:
         """
         执行SQL语句
@@ -116,6 +176,7 @@ class Database:
         """
         with self.get_connection() as conn:
             cursor = conn.cursor()
+            cursor.row_factory = sqlite3.Row
             cursor.execute(query, params)
             row = cursor.fetchone()
             return dict(row) if row else None
@@ -133,6 +194,7 @@ class Database:
         """
         with self.get_connection() as conn:
             cursor = conn.cursor()
+            cursor.row_factory = sqlite3.Row
             cursor.execute(query, params)
             rows = cursor.fetchall()
             return [dict(row) for row in rows]
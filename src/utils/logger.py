@@ -3,11 +3,21 @@
 配置和管理应用的日志记录
 """
 
+import atexit
 import logging
+import logging.handlers
+import queue
 import sys
+from typing import Optional, Set
 from pathlib import Path
 from .config import settings
 
+# 后台写日志的监听线程（重复调用 setup_logger 时先停止旧的）
+_listener: Optional[logging.handlers.QueueListener] = None
+
+# 已确认存在的日志目录（重复调用 setup_logger 时不再 mkdir）
+_ready_dirs: Set[Path] = set()
+
 
 def setup_logger(name: str = "feishu_diary") -> logging.Logger:
     """
@@ -21,11 +31,16 @@ def setup_logger(name: str = "feishu_diary") -> logging.Logger:
     """
     # 创建日志目录
     log_dir = Path(settings.log_file).parent
-    log_dir.mkdir(parents=True, exist_ok=True)
+    if log_dir not in _ready_dirs:
+        log_dir.mkdir(parents=True, exist_ok=True)
+        _ready_dirs.add(log_dir)
+    
+    # 日志级别（配置无效时退回 INFO）
+    level = getattr(logging, settings.log_level.upper(), logging.INFO)
     
     # 创建日志记录器
     logger = logging.getLogger(name)
-    logger.setLevel(getattr(logging, settings.log_level.upper()))
+    logger.setLevel(level)
     
     # 清除已有的处理器
     logger.handlers.clear()
@@ -40,16 +55,40 @@ def setup_logger(name: str = "feishu_diary") -> logging.Logger:
     console_handler = logging.StreamHandler(sys.stdout)
     console_handler.setLevel(logging.INFO)
     console_handler.setFormatter(formatter)
-    logger.addHandler(console_handler)
     
-    # 文件处理器
-    file_handler = logging.FileHandler(settings.log_file, encoding="utf-8")
-    file_handler.setLevel(getattr(logging, settings.log_level.upper()))
+    # 文件处理器（按大小轮转）
+    file_handler = logging.handlers.RotatingFileHandler(
+        settings.log_file,
+        maxBytes=settings.log_max_bytes,
+        backupCount=settings.log_backup_count,
+        encoding="utf-8",
+        delay=True
+    )
+    file_handler.setLevel(level)
     file_handler.setFormatter(formatter)
-    logger.addHandler(file_handler)
+    
+    # 记录只入队，由后台线程写控制台和文件，避免阻塞事件循环
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+    log_queue = queue.SimpleQueue()
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    _listener = logging.handlers.QueueListener(
+        log_queue, console_handler, file_handler, respect_handler_level=True
+    )
+    _listener.start()
     
     return logger
 
 
+def stop_logger():
+    """停止后台日志线程，写完队列中剩余的记录（进程退出时自动调用）"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
 # 创建全局日志记录器
 logger = setup_logger()
+atexit.register(stop_logger)
@@ -0,0 +1,38 @@
+"""
+时间工具模块
+提供热点路径上使用的日期/时间字符串
+"""
+
+import time
+from datetime import date, datetime, timedelta
+
+# (缓存失效的时间戳, 日期字符串)，在下一个本地零点失效
+_today_cache = (0.0, "")
+
+
+def today_str() -> str:
+    """
+    获取今天的日期字符串 (YYYY-MM-DD)，同一天内复用缓存结果
+
+    Returns:
+        日期字符串
+    """
+    global _today_cache
+    expires_at, today = _today_cache
+    if time.time() < expires_at:
+        return today
+
+    current = date.today()
+    next_midnight = datetime.combine(current + timedelta(days=1), datetime.min.time()).timestamp()
+    _today_cache = (next_midnight, current.isoformat())
+    return _today_cache[1]
+
+
+def now_iso() -> str:
+    """
+    获取当前时间的ISO格式字符串（精确到秒）
+
+    Returns:
+        时间字符串
+    """
+    return datetime.now().isoformat(timespec="seconds")
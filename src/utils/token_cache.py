@@ -0,0 +1,64 @@
+"""
+访问令牌缓存模块
+缓存飞书 access_token，过期前自动刷新
+"""
+
+import time
+import asyncio
+from typing import Awaitable, Callable, Optional, Tuple
+
+# 飞书返回的 access_token 无效/过期错误码（令牌被重置或提前失效时出现）
+INVALID_TOKEN_CODES = frozenset({99991663, 99991664, 99991668, 99991677})
+
+
+class TokenCache:
+    """访问令牌缓存（过期时间使用 time.monotonic()，不受系统时间调整影响）"""
+
+    def __init__(self, fetch: Callable[[], Awaitable[Tuple[str, float]]], refresh_margin: float):
+        """
+        初始化令牌缓存
+
+        Args:
+            fetch: 请求新令牌的协程函数，返回 (token, 有效秒数)，失败时 token 为空字符串
+            refresh_margin: 提前刷新的秒数
+        """
+        self._fetch = fetch
+        self._refresh_margin = refresh_margin
+        self._token: Optional[str] = None
+        self._exp: float = 0.0
+        self._lock = asyncio.Lock()
+
+    def _valid(self) -> bool:
+        """缓存的令牌是否仍在有效期内"""
+        return bool(self._token) and time.monotonic() < self._exp - self._refresh_margin
+
+    async def get(self) -> str:
+        """
+        获取访问令牌，缓存失效时请求新令牌（并发调用只请求一次）
+
+        Returns:
+            access_token，获取失败时返回空字符串
+        """
+        if self._valid():
+            return self._token
+
+        async with self._lock:
+            # 等待锁期间可能已被其他协程刷新
+            if self._valid():
+                return self._token
+            token, expire = await self._fetch()
+            if token:
+                self._token = token
+                self._exp = time.monotonic() + expire
+            return token
+
+    def invalidate(self, token: Optional[str] = None):
+        """
+        丢弃缓存的令牌（接口返回 INVALID_TOKEN_CODES 时调用）
+
+        Args:
+            token: 被判定失效的令牌；缓存已换成其他令牌时不再丢弃，避免并发请求重复刷新
+        """
+        if token is None or token == self._token:
+            self._token = None
+            self._exp = 0.0